@@ -1,3 +1,35 @@
 from django.contrib import admin
+from django.http import Http404, HttpResponse, JsonResponse
+from django.template.response import TemplateResponse
+
+from app import profiling
 
 # Register your models here.
+
+
+def profiles(request):
+    """Lists the stored request profiles (see app.profiling)"""
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Request profiles',
+        'captures': profiling.list_captures(),
+        'token': profiling.make_token(),
+    }
+    return TemplateResponse(request, 'admin/profiles.html', context)
+
+
+def profile_download(request, capture_id, format='speedscope'):
+    """Downloads a stored profile as a speedscope file or as folded stacks"""
+    try:
+        document = profiling.load(capture_id)
+    except (ValueError, FileNotFoundError):
+        raise Http404(f'Profile {capture_id} not found')
+
+    if format == 'folded':
+        response = HttpResponse(profiling.to_folded(document), content_type='text/plain')
+        filename = f'{capture_id}.folded'
+    else:
+        response = JsonResponse(document)
+        filename = f'{capture_id}.speedscope.json'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
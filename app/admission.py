@@ -0,0 +1,237 @@
+"""
+Admission control for the heavy analytics views.
+
+`limit()` wraps a view (see core/urls.py) so that at most `concurrency`
+requests run it at once across every worker and dyno, a bounded number
+(`queue`) wait up to `queue_timeout` seconds for a free slot, and the rest get
+an immediate 503 with Retry-After. Slots are Postgres session advisory locks on
+the primary, so they are released even if a worker dies mid-request.
+
+While the view runs, every query it sends is bounded by `statement_timeout`
+(milliseconds) and every SELECT, prepared ones included (app.statements), by
+`max_rows`, which the server enforces with a LIMIT, and in-flight queries are
+cancelled if the client disconnects (detected on the gunicorn socket).
+"""
+import functools
+import logging
+import select
+import socket
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+
+import psycopg2
+from psycopg2 import errors as pg_errors
+from django.db import DatabaseError, connections
+from django.http import HttpResponse
+
+from app import statements
+
+logger = logging.getLogger(__name__)
+
+# Connection the slot locks are taken on
+LOCK_DB = 'default'
+
+# Status sent (and logged) when the client went away, as nginx does
+CLIENT_CLOSED = 499
+
+TRY_SLOTS = '''
+    SELECT slot FROM unnest(%s::INTEGER[]) AS slot
+    WHERE pg_try_advisory_lock(%s, slot)
+    LIMIT 1;
+'''
+
+
+class RowLimitExceeded(DatabaseError):
+    pass
+
+
+class ClientDisconnected(DatabaseError):
+    pass
+
+
+def _lock_key(name):
+    return zlib.crc32(name.encode()) & 0x7fffffff
+
+
+def _try_slots(key, slots):
+    with connections[LOCK_DB].cursor() as cursor:
+        cursor.execute(TRY_SLOTS, [list(slots), key])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _release(key, slot):
+    try:
+        with connections[LOCK_DB].cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s);', [key, slot])
+    except DatabaseError:
+        # Session locks die with the connection, so never reuse it holding one
+        connections[LOCK_DB].close()
+
+
+def acquire(key, concurrency, queue, queue_timeout):
+    """
+    Returns the slot taken for key, or None if all slots stayed busy or the
+    queue was full. Slots 0..concurrency-1 run, negative slots are queue places.
+    """
+    running = range(concurrency)
+    slot = _try_slots(key, running)
+    if slot is not None or not queue:
+        return slot
+
+    place = _try_slots(key, range(-1, -queue - 1, -1))
+    if place is None:
+        return None
+    try:
+        deadline = time.monotonic() + queue_timeout
+        delay = 0.01
+        while time.monotonic() < deadline:
+            time.sleep(min(delay, max(0, deadline - time.monotonic())))
+            slot = _try_slots(key, running)
+            if slot is not None:
+                return slot
+            delay = min(delay * 2, 0.25)
+        return None
+    finally:
+        _release(key, place)
+
+
+class QueryGuard:
+    """Execute wrapper applying a statement timeout and a row cap to the queries it sees"""
+
+    def __init__(self, statement_timeout=None, max_rows=None):
+        self.statement_timeout = statement_timeout
+        self.max_rows = max_rows
+        # Aliases whose session timeout is set (and must be reset afterwards)
+        self.timed = set()
+        self.persistent = set()
+        self.disconnected = threading.Event()
+
+    def _set_timeout(self, connection):
+        # A SET inside a transaction is undone if it rolls back, so it only
+        # lasts for the rest of the view when it ran in autocommit
+        if connection.alias in self.persistent and not connection.in_atomic_block:
+            return
+        with connection.connection.cursor() as cursor:
+            cursor.execute('SET statement_timeout = %s;', [int(self.statement_timeout)])
+        self.timed.add(connection.alias)
+        if not connection.in_atomic_block:
+            self.persistent.add(connection.alias)
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.disconnected.is_set():
+            raise ClientDisconnected('The client closed the connection')
+        connection = context['connection']
+        if self.statement_timeout:
+            self._set_timeout(connection)
+        if self.max_rows is not None and not many:
+            sql = statements.capped(sql, self.max_rows)
+        result = execute(sql, params, many, context)
+        rowcount = context['cursor'].rowcount
+        if self.max_rows is not None and rowcount > self.max_rows:
+            raise RowLimitExceeded(f'Query returned {rowcount} rows, more than the {self.max_rows} allowed')
+        return result
+
+    def reset(self):
+        for alias in self.timed:
+            connection = connections[alias]
+            if connection.connection is None:
+                continue
+            try:
+                with connection.connection.cursor() as cursor:
+                    cursor.execute('RESET statement_timeout;')
+            except psycopg2.Error:
+                connection.close()
+
+
+class DisconnectWatcher(threading.Thread):
+    """
+    Cancels the queries running on this thread's connections once sock is
+    closed by the client, and makes guard refuse any further ones.
+    """
+
+    def __init__(self, sock, guard, poll_seconds=0.25):
+        super().__init__(name='disconnect-watcher', daemon=True)
+        self.sock = sock
+        self.guard = guard
+        self.poll_seconds = poll_seconds
+        self.pg_connections = list(connections.all())
+        self._done = threading.Event()
+
+    def client_gone(self):
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def run(self):
+        while not self._done.wait(self.poll_seconds):
+            if self.client_gone():
+                self.guard.disconnected.set()
+                for connection in self.pg_connections:
+                    if connection.connection is not None:
+                        connection.connection.cancel()
+                return
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def _unavailable(message, retry_after):
+    response = HttpResponse(message, status=503, content_type='text/plain')
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def _query_canceled(error):
+    return isinstance(error.__cause__, pg_errors.QueryCanceled)
+
+
+def limit(view, concurrency=2, queue=4, queue_timeout=5, statement_timeout=None,
+          max_rows=None, retry_after=None, name=None):
+    """Returns view wrapped with the admission limits above"""
+    name = name or f'{view.__module__}.{view.__qualname__}'
+    key = _lock_key(name)
+    retry_after = retry_after or max(1, round(queue_timeout))
+
+    @functools.wraps(view)
+    def limited(request, *args, **kwargs):
+        slot = acquire(key, concurrency, queue, queue_timeout)
+        if slot is None:
+            logger.warning('Rejected %s: all %d slots and %d queue places busy', name, concurrency, queue)
+            return _unavailable('Too many requests for this page, please retry shortly', retry_after)
+
+        guard = QueryGuard(statement_timeout, max_rows)
+        sock = request.META.get('gunicorn.socket')
+        watcher = DisconnectWatcher(sock, guard) if sock is not None else None
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(guard))
+                if max_rows is not None:
+                    stack.enter_context(statements.row_cap(max_rows))
+                if watcher:
+                    watcher.start()
+                return view(request, *args, **kwargs)
+        except DatabaseError as e:
+            if guard.disconnected.is_set():
+                return HttpResponse(status=CLIENT_CLOSED, reason='Client Closed Request')
+            if isinstance(e, RowLimitExceeded) or _query_canceled(e):
+                logger.warning('Stopped %s: %s', name, e)
+                return _unavailable('This page is too expensive to build right now, please retry shortly', retry_after)
+            raise
+        finally:
+            if watcher:
+                watcher.stop()
+            guard.reset()
+            _release(key, slot)
+
+    return limited
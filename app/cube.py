@@ -0,0 +1,242 @@
+"""
+Pre-aggregated cube over date hierarchy x ship_type x verifier_country.
+
+`fact_cube` only stores the base cuboid, one row per (year, year_half,
+quarter, month, week, ship_type, verifier_country), with the row count and
+the sum, count, min and max of each measure. Every coarser slice is answered
+by re-aggregating those rows, which is exact for all four statistics, so the
+cube never has to go back to `fact`. A statement trigger on `fact` adds
+inserted rows to their cells and recomputes the cells of updated or deleted
+rows, holding an advisory lock per cell so concurrent writers cannot double
+count.
+"""
+from django.db import connections, transaction
+
+from app.utils import namedtuplefetchall
+
+DATE_LEVELS = ['year', 'year_half', 'quarter', 'month', 'week']
+DIMENSIONS = DATE_LEVELS + ['ship_type', 'verifier_country']
+MEASURES = ['total_co2', 'total_fuel_consmp', 'total_time_sea', 'eedi']
+
+DIMENSION_COLUMNS = {
+    'year': 'd.year',
+    'year_half': 'd.year_half',
+    'quarter': 'd.quarter',
+    'month': 'd.month',
+    'week': 'd.week',
+    'ship_type': 's.ship_type',
+    'verifier_country': 'v.verifier_country',
+}
+
+KEYS = ', '.join(f'{column} AS {dim}' for dim, column in DIMENSION_COLUMNS.items())
+AGGREGATES = ', '.join(
+    ['COUNT(*) AS n']
+    + [
+        f'SUM(f.{m})::DOUBLE PRECISION AS {m}_sum, COUNT(f.{m}) AS {m}_count, '
+        f'MIN(f.{m})::DOUBLE PRECISION AS {m}_min, MAX(f.{m})::DOUBLE PRECISION AS {m}_max'
+        for m in MEASURES
+    ]
+)
+JOINS = '''
+    FROM {rows} f, date_dim d, ship_dim s, verifier_dim v
+    WHERE f.date_id = d.date_id AND f.ship_id = s.ship_id AND f.verifier_id = v.verifier_id
+'''
+GROUP_BY = f'GROUP BY {", ".join(DIMENSION_COLUMNS.values())}'
+BASE_CELLS = f'''
+    SELECT {KEYS}, {AGGREGATES}
+    {JOINS.format(rows='fact')}
+    {GROUP_BY}
+'''
+
+CREATE_TABLE = f'''
+    CREATE TABLE IF NOT EXISTS fact_cube AS {BASE_CELLS} WITH NO DATA;
+    CREATE INDEX IF NOT EXISTS fact_date_id_idx ON fact (date_id);
+'''
+
+# One row per cell; NULL dimensions are kept apart by the cell locks below
+CREATE_KEY = f'''
+    DROP INDEX IF EXISTS fact_cube_cell_idx;
+    CREATE UNIQUE INDEX fact_cube_cell_key ON fact_cube ({", ".join(DIMENSIONS)});
+'''
+
+
+def _same_cell(left, right):
+    return (
+        f'({", ".join(f"{left}.{dim}" for dim in DIMENSIONS)}) '
+        f'IS NOT DISTINCT FROM ({", ".join(f"{right}.{dim}" for dim in DIMENSIONS)})'
+    )
+
+
+def _touched(*tables):
+    """Returns the query of the cells the rows of the transition tables fall in"""
+    return ' UNION '.join(f'SELECT {KEYS} {JOINS.format(rows=table)}' for table in tables)
+
+
+def _lock_cells(*tables):
+    # In hash order, so writers touching the same cells cannot deadlock
+    return f'''
+        PERFORM pg_advisory_xact_lock(hashtext('fact_cube'), h)
+        FROM (SELECT DISTINCT hashtext(t::TEXT) AS h FROM ({_touched(*tables)}) t ORDER BY h) cells;
+    '''
+
+
+# Adds the cells of the inserted rows to the cube
+ADD_CELLS = f'''
+        WITH delta AS (
+            SELECT {KEYS}, {AGGREGATES}
+            {JOINS.format(rows='new_rows')}
+            {GROUP_BY}
+        ), updated AS (
+            UPDATE fact_cube c SET
+                n = c.n + x.n,
+                {", ".join(
+                    f"{m}_sum = CASE WHEN c.{m}_count + x.{m}_count = 0 THEN NULL "
+                    f"ELSE COALESCE(c.{m}_sum, 0) + COALESCE(x.{m}_sum, 0) END, "
+                    f"{m}_count = c.{m}_count + x.{m}_count, "
+                    f"{m}_min = LEAST(c.{m}_min, x.{m}_min), "
+                    f"{m}_max = GREATEST(c.{m}_max, x.{m}_max)"
+                    for m in MEASURES
+                )}
+            FROM delta x
+            WHERE {_same_cell('c', 'x')}
+            RETURNING c.*
+        )
+        INSERT INTO fact_cube
+        SELECT * FROM delta x
+        WHERE NOT EXISTS (SELECT 1 FROM updated c WHERE {_same_cell('c', 'x')});
+'''
+
+
+def _recompute_cells(*tables):
+    """
+    Returns the statements recomputing, from fact, the cells the rows of the
+    transition tables fall in. Minimums and maximums cannot be taken back, so
+    deletes and updates re-aggregate the cells they touch.
+    """
+    touched = _touched(*tables)
+    return f'''
+        DELETE FROM fact_cube c
+        WHERE EXISTS (SELECT 1 FROM ({touched}) t WHERE {_same_cell('c', 't')});
+        INSERT INTO fact_cube
+        SELECT * FROM (
+            SELECT {KEYS}, {AGGREGATES}
+            {JOINS.format(rows='fact')}
+              AND f.date_id IN (
+                  SELECT dd.date_id FROM date_dim dd, ({touched}) t
+                  WHERE ({", ".join(f"dd.{level}" for level in DATE_LEVELS)})
+                        IS NOT DISTINCT FROM ({", ".join(f"t.{level}" for level in DATE_LEVELS)})
+              )
+            {GROUP_BY}
+        ) x
+        WHERE EXISTS (SELECT 1 FROM ({touched}) t WHERE {_same_cell('x', 't')});
+    '''
+
+
+# Statement level, with the changed rows in transition tables, so a bulk
+# load costs one pass over its rows instead of one cell rebuild per row
+CREATE_TRIGGER_FUNCTION = f'''
+    CREATE OR REPLACE FUNCTION fact_cube_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {_lock_cells('new_rows')}
+            {ADD_CELLS}
+        ELSIF TG_OP = 'UPDATE' THEN
+            {_lock_cells('old_rows', 'new_rows')}
+            {_recompute_cells('old_rows', 'new_rows')}
+        ELSE
+            {_lock_cells('old_rows')}
+            {_recompute_cells('old_rows')}
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+CREATE_TRIGGER = '''
+    DROP TRIGGER IF EXISTS fact_cube ON fact;
+    DROP TRIGGER IF EXISTS fact_cube_insert ON fact;
+    DROP TRIGGER IF EXISTS fact_cube_update ON fact;
+    DROP TRIGGER IF EXISTS fact_cube_delete ON fact;
+    CREATE TRIGGER fact_cube_insert
+    AFTER INSERT ON fact REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE fact_cube_trigger();
+    CREATE TRIGGER fact_cube_update
+    AFTER UPDATE ON fact REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE fact_cube_trigger();
+    CREATE TRIGGER fact_cube_delete
+    AFTER DELETE ON fact REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE fact_cube_trigger();
+'''
+
+
+def install(using='default'):
+    """Creates the cube table and the trigger keeping it up to date"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(CREATE_TABLE)
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'fact_cube_cell_key';")
+        if cursor.fetchone() is None:
+            # Cubes from before the unique key can hold duplicate cells;
+            # they are emptied, rebuild() fills them again
+            cursor.execute('DELETE FROM fact_cube;')
+            cursor.execute(CREATE_KEY)
+        cursor.execute(CREATE_TRIGGER_FUNCTION)
+        cursor.execute(CREATE_TRIGGER)
+
+
+def rebuild(using='default'):
+    """Recomputes every base cell of the cube from the fact table"""
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('LOCK TABLE fact IN SHARE MODE;')
+            cursor.execute('DELETE FROM fact_cube;')
+            cursor.execute(f'INSERT INTO fact_cube {BASE_CELLS};')
+
+
+def drill_down(by):
+    """Returns `by` with the next finer date level added, or None at the finest level"""
+    present = [level for level in DATE_LEVELS if level in by]
+    finer = DATE_LEVELS[DATE_LEVELS.index(present[-1]) + 1:] if present else DATE_LEVELS
+    if not finer:
+        return None
+    return [*by, finer[0]]
+
+
+def roll_up(by):
+    """Returns `by` without its finest date level, or None if it has no date level"""
+    present = [level for level in DATE_LEVELS if level in by]
+    if not present:
+        return None
+    return [dim for dim in by if dim != present[-1]]
+
+
+def query(by, filters=None, using='default'):
+    """
+    Returns one row per combination of the `by` dimensions, restricted to the
+    cells matching `filters` (a dict of dimension to value), with the row count
+    and the sum, count, avg, min and max of every measure.
+    """
+    filters = filters or {}
+    unknown = [dim for dim in [*by, *filters] if dim not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f'Unknown cube dimension(s): {", ".join(unknown)}')
+
+    aggregates = ', '.join(
+        ['SUM(n)::BIGINT AS n']
+        + [
+            f'SUM({m}_sum) AS {m}_sum, SUM({m}_count)::BIGINT AS {m}_count, '
+            f'SUM({m}_sum) / NULLIF(SUM({m}_count), 0) AS {m}_avg, '
+            f'MIN({m}_min) AS {m}_min, MAX({m}_max) AS {m}_max'
+            for m in MEASURES
+        ]
+    )
+    # Compare as text so filter values from the query string match any column type
+    where = ' AND '.join(f'{dim}::TEXT = %s' for dim in filters)
+    group_by = ', '.join(by)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'''
+            SELECT {f"{group_by}, " if by else ""}{aggregates}
+            FROM fact_cube
+            {f"WHERE {where}" if where else ""}
+            {f"GROUP BY {group_by} ORDER BY {group_by}" if by else ""}
+        ''', [str(value) for value in filters.values()])
+        return namedtuplefetchall(cursor)
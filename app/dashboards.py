@@ -0,0 +1,182 @@
+"""
+Stale-while-revalidate cache for the expensive chart pages.
+
+A dashboard is a function building the template context of a page, plus the
+tables it reads. Its last good context is cached together with the versions
+of those tables (see app.invalidation). When a table changed, or the entry is
+older than settings.DASHBOARD_MAX_AGE, the stale context is still served and
+the dashboard is rebuilt on a background thread. A cache lock makes sure only
+one rebuild per dashboard runs at a time; requests finding no context at all
+wait up to settings.DASHBOARD_COLD_WAIT seconds for the rebuild holding it,
+then build their own. gunicorn.conf.py builds every dashboard before a worker
+takes requests, so that wait is the exception.
+
+Rebuilds read from the primary: the versions they are stamped with are read
+before their queries, which a lagging replica might not reflect yet.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from app.invalidation import version
+from app.routers import use_primary
+
+logger = logging.getLogger(__name__)
+
+_dashboards = {}
+_executor = None
+
+
+def register(name, build, tables):
+    """Registers build() as the context builder of dashboard name, reading tables"""
+    _dashboards[name] = (build, tables)
+
+
+def _cache_key(name):
+    return f'dashboard-{name}'
+
+
+def _lock_key(name):
+    return f'{_cache_key(name)}-LOCK'
+
+
+def _rebuild_timeout():
+    return getattr(settings, 'DASHBOARD_REBUILD_TIMEOUT', 5 * 60)
+
+
+def _cold_wait():
+    return getattr(settings, 'DASHBOARD_COLD_WAIT', 5)
+
+
+def _versions(tables):
+    return tuple(version(table) for table in tables)
+
+
+def _max_age():
+    return getattr(settings, 'DASHBOARD_MAX_AGE', 10 * 60)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'DASHBOARD_REFRESH_THREADS', 1),
+            thread_name_prefix='dashboard-refresh',
+        )
+    return _executor
+
+
+def is_fresh(name, entry):
+    build, tables = _dashboards[name]
+    return (
+        entry is not None
+        and entry['versions'] == _versions(tables)
+        and time.time() - entry['built_at'] < _max_age()
+    )
+
+
+def _build(name):
+    build, tables = _dashboards[name]
+    # Read the versions first so changes made during the build leave it stale
+    versions = _versions(tables)
+    with use_primary():
+        context = build()
+    entry = {
+        'versions': versions,
+        'built_at': time.time(),
+        'context': context,
+    }
+    cache.set(_cache_key(name), entry, timeout=None)
+    return entry
+
+
+def rebuild(name):
+    """Builds dashboard name now, stores it and returns its context"""
+    return _build(name)['context']
+
+
+def _rebuild_in_background(name):
+    lock_key = _lock_key(name)
+    try:
+        rebuild(name)
+    except Exception:
+        logger.exception('Background rebuild of dashboard %s failed', name)
+    finally:
+        cache.delete(lock_key)
+        connections.close_all()
+
+
+def schedule_rebuild(name):
+    """
+    Queues a background rebuild of dashboard name unless one is already
+    running. Returns its future, or None if it was not queued.
+    """
+    if cache.add(_lock_key(name), True, timeout=_rebuild_timeout()):
+        return _get_executor().submit(_rebuild_in_background, name)
+    return None
+
+
+def _build_cold(name):
+    """Builds a dashboard that has no cached entry, once for all concurrent requests"""
+    deadline = time.monotonic() + _cold_wait()
+    while not cache.add(_lock_key(name), True, timeout=_rebuild_timeout()):
+        entry = cache.get(_cache_key(name))
+        if entry is not None:
+            return entry
+        if time.monotonic() > deadline:
+            # The rebuild holding the lock is slow or stuck; build it here
+            return _build(name)
+        time.sleep(0.05)
+    try:
+        entry = cache.get(_cache_key(name))
+        return entry if entry is not None else _build(name)
+    finally:
+        cache.delete(_lock_key(name))
+
+
+def get_with_versions(name):
+    """
+    Returns the context of dashboard name, as get() does, and the versions
+    of its tables it was built from, as a {table: version} dict.
+    """
+    entry = cache.get(_cache_key(name))
+    if entry is None:
+        entry = _build_cold(name)
+    elif not is_fresh(name, entry):
+        schedule_rebuild(name)
+    build, tables = _dashboards[name]
+    return entry['context'], dict(zip(tables, entry['versions']))
+
+
+def get(name):
+    """
+    Returns the context of dashboard name: the cached one if there is one,
+    scheduling a rebuild if it is stale, or a freshly built one otherwise.
+    """
+    return get_with_versions(name)[0]
+
+
+def warm(names=None, stale_in_background=False):
+    """
+    Builds every (or the named) dashboard whose cached context is not fresh
+    and returns their names. Missing ones are always built before returning,
+    once for all the workers sharing the cache; stale ones are only queued
+    for a background rebuild if stale_in_background.
+    """
+    built = []
+    for name in names or _dashboards:
+        entry = cache.get(_cache_key(name))
+        if entry is None:
+            _build_cold(name)
+        elif is_fresh(name, entry):
+            continue
+        elif stale_in_background:
+            schedule_rebuild(name)
+        else:
+            rebuild(name)
+        built.append(name)
+    return built
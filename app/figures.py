@@ -0,0 +1,127 @@
+"""
+Lightweight Plotly figure rendering.
+
+Builds figure dicts straight from numpy arrays instead of going through
+plotly.graph_objects validation and plotly's JSON encoder. Numeric arrays are
+sent as base64 typed arrays ({'dtype': 'f8', 'bdata': ...}), which plotly.js
+decodes natively since 2.28, so no float is ever formatted as decimal text.
+Pages using figure_div() must load PLOTLY_JS_URL once (see base.html).
+"""
+import base64
+import json
+import uuid
+
+import numpy as np
+
+PLOTLY_JS_URL = 'https://cdn.plot.ly/plotly-2.35.2.min.js'
+
+# Trace attributes holding data arrays
+ARRAY_KEYS = {'x', 'y', 'z', 'values', 'labels', 'text'}
+
+# numpy dtype kind and size to plotly.js typed array dtype
+TYPED_ARRAY_DTYPES = {
+    ('f', 8): 'f8',
+    ('f', 4): 'f4',
+    ('i', 4): 'i4',
+    ('i', 2): 'i2',
+    ('i', 1): 'i1',
+    ('u', 4): 'u4',
+    ('u', 2): 'u2',
+    ('u', 1): 'u1',
+}
+
+# Characters that must not appear verbatim inside a <script> element
+SCRIPT_ESCAPES = {
+    ord('<'): '\\u003c',
+    ord('>'): '\\u003e',
+    ord('&'): '\\u0026',
+}
+
+
+def encode_array(values, dtype=None):
+    """
+    Returns values as a plotly.js typed array spec if they are numeric,
+    or as a plain list otherwise (e.g. category names).
+    """
+    array = np.asarray(values) if dtype is None else np.asarray(values, dtype=dtype)
+    if array.dtype.kind == 'O':
+        # Decimals and other numbers coming straight from the database
+        try:
+            array = array.astype(float)
+        except (TypeError, ValueError):
+            return array.tolist()
+    if array.dtype.kind in 'iu' and array.dtype.itemsize == 8:
+        # plotly.js has no 64 bit integer arrays
+        array = array.astype(float)
+    code = TYPED_ARRAY_DTYPES.get((array.dtype.kind, array.dtype.itemsize))
+    if code is None:
+        return array.tolist()
+    data = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    return {'dtype': code, 'bdata': base64.b64encode(data.tobytes()).decode('ascii')}
+
+
+def trace(type, **props):
+    """Returns a trace dict of the given type with its data arrays encoded"""
+    return {
+        'type': type,
+        **{
+            key: encode_array(value) if key in ARRAY_KEYS and value is not None else value
+            for key, value in props.items()
+        },
+    }
+
+
+def scatter(x, y, **props):
+    return trace('scatter', x=x, y=y, **props)
+
+
+def bar(x, y, **props):
+    return trace('bar', x=x, y=y, **props)
+
+
+def pie(labels, values, **props):
+    return trace('pie', labels=labels, values=values, **props)
+
+
+def expand_layout(layout):
+    """
+    Expands plotly.py's magic underscore keys (e.g. 'xaxis_title') and plain
+    string titles into the nested form plotly.js expects.
+    """
+    expanded = {}
+    for key, value in layout.items():
+        parts = key.split('_')
+        if len(parts) > 1 and parts[0] in ('xaxis', 'yaxis', 'legend'):
+            target = expanded.setdefault(parts[0], {})
+            target['_'.join(parts[1:])] = value
+        else:
+            expanded[key] = value
+    for container in [expanded, *(v for v in expanded.values() if isinstance(v, dict))]:
+        if isinstance(container.get('title'), str):
+            container['title'] = {'text': container['title']}
+    return expanded
+
+
+def to_json(obj):
+    """Compact JSON that is safe to embed in a <script> element"""
+    return json.dumps(obj, separators=(',', ':')).translate(SCRIPT_ESCAPES)
+
+
+def figure_div(data, layout, div_id=None):
+    """
+    Returns the HTML of a div drawing the figure, the counterpart of
+    plotly.offline.plot(..., output_type='div') without the bundled plotly.js.
+    """
+    if isinstance(data, dict):
+        data = [data]
+    div_id = div_id or str(uuid.uuid4())
+    layout = expand_layout(layout)
+    style = ''.join(
+        f'{dim}:{layout[dim]}px;' for dim in ('height', 'width') if dim in layout
+    )
+    return (
+        f'<div id="{div_id}" class="plotly-graph-div" style="{style}"></div>'
+        f'<script type="text/javascript">'
+        f'Plotly.newPlot("{div_id}",{to_json(data)},{to_json(layout)},{{"responsive":true}});'
+        f'</script>'
+    )
@@ -2,17 +2,22 @@ from django import forms
 from django.db import connections
 from django.core.cache import cache
 
+from app.invalidation import versioned_key
+from app.routers import read_db
+
 DAY_IN_SEC = 24 * 60 * 60
 
 
 def get_choices(col: str):
-    # Try to get choices from cache
-    col_choices_key = f'{col}-CHOICES'
-    if col_choices_key in cache:
-        return cache[col_choices_key]
+    # Try to get choices from cache. The key carries the table version, so
+    # a change notified by any worker makes every worker reload the choices
+    col_choices_key = versioned_key(f'{col}-CHOICES', 'co2emission_reduced')
+    choices = cache.get(col_choices_key)
+    if choices is not None:
+        return choices
 
     # If choices are not in cache, query db, set cache and then return
-    with connections['default'].cursor() as cursor:
+    with connections[read_db()].cursor() as cursor:
         cursor.execute(f'SELECT DISTINCT {col} FROM co2emission_reduced')
         choices = [('', '---------')]
         for row in cursor.fetchall():
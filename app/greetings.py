@@ -0,0 +1,128 @@
+"""
+Write-behind buffer and bounded reads for the app_greeting heartbeat table.
+
+Each hit of /db/ adds a timestamp to this worker's buffer instead of running
+an INSERT. A flusher thread writes the buffer in one statement every
+GREETING_FLUSH_SECONDS, or as soon as it holds GREETING_BATCH_SIZE entries.
+Reads only fetch the newest entries through the index on "when", so the
+page costs the same however large the table is. `trim()` (run by the
+trim_greetings command) deletes rows older than GREETING_RETENTION_DAYS.
+Entries still in the buffer are lost if a worker is killed.
+"""
+import atexit
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.utils import timezone
+
+from app.routers import PRIMARY
+
+logger = logging.getLogger(__name__)
+
+_buffer = []
+_lock = threading.Lock()
+_flush_now = threading.Event()
+_flusher = None
+
+
+def _batch_size():
+    return getattr(settings, 'GREETING_BATCH_SIZE', 100)
+
+
+def _flush_seconds():
+    return getattr(settings, 'GREETING_FLUSH_SECONDS', 5)
+
+
+def add(when=None):
+    """Queues a greeting for the next flush"""
+    with _lock:
+        _buffer.append(when or timezone.now())
+        full = len(_buffer) >= _batch_size()
+    _start_flusher()
+    if full:
+        _flush_now.set()
+
+
+def pending():
+    """Returns the greetings of this worker that are not written yet"""
+    with _lock:
+        return list(_buffer)
+
+
+def flush(using=PRIMARY):
+    """Writes the buffered greetings in one INSERT and returns how many there were"""
+    with _lock:
+        batch = _buffer[:]
+        del _buffer[:]
+    if not batch:
+        return 0
+    try:
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO app_greeting ("when") SELECT unnest(%s::TIMESTAMPTZ[]);', [batch]
+            )
+    except DatabaseError:
+        logger.exception('Could not write %d greetings, keeping them for the next flush', len(batch))
+        connections[using].close()
+        with _lock:
+            # Keep at most a few batches around while the database is away
+            _buffer[:0] = batch
+            del _buffer[:-10 * _batch_size()]
+        return 0
+    return len(batch)
+
+
+def _run_flusher():
+    while True:
+        _flush_now.wait(_flush_seconds())
+        _flush_now.clear()
+        flush()
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run_flusher, name='greeting-flusher', daemon=True)
+            _flusher.start()
+            atexit.register(flush)
+
+
+def recent(limit=None, before=None, using=PRIMARY):
+    """
+    Returns the newest `limit` greetings (older than `before` if given) as
+    dicts with a 'when' key, newest first, including this worker's pending ones.
+    """
+    limit = limit or getattr(settings, 'GREETING_PAGE_SIZE', 20)
+    with connections[using].cursor() as cursor:
+        if before is None:
+            cursor.execute('SELECT "when" FROM app_greeting ORDER BY "when" DESC LIMIT %s;', [limit])
+        else:
+            cursor.execute('''
+                SELECT "when" FROM app_greeting WHERE "when" < %s ORDER BY "when" DESC LIMIT %s;
+            ''', [before, limit])
+        stored = [row[0] for row in cursor.fetchall()]
+    unsaved = [when for when in pending() if before is None or when < before]
+    return [{'when': when} for when in sorted(stored + unsaved, reverse=True)[:limit]]
+
+
+def trim(days=None, batch_size=10000, using=PRIMARY):
+    """Deletes greetings older than days, batch_size rows at a time, and returns how many"""
+    days = getattr(settings, 'GREETING_RETENTION_DAYS', 7) if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted = 0
+    with connections[using].cursor() as cursor:
+        while True:
+            cursor.execute('''
+                DELETE FROM app_greeting WHERE id IN (
+                    SELECT id FROM app_greeting WHERE "when" < %s LIMIT %s
+                );
+            ''', [cutoff, batch_size])
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return deleted
@@ -0,0 +1,213 @@
+"""
+Cross-worker cache invalidation through Postgres LISTEN/NOTIFY.
+
+Statement triggers on the warehouse tables send one NOTIFY on CHANNEL per
+statement, with the table, the operation and the keys of the changed rows. Each gunicorn worker runs one
+listener thread (started from gunicorn.conf.py) that bumps the table's
+version in the cache and calls the callbacks subscribed to that table.
+Cache entries built from a table should use `versioned_key()`, so a bump
+makes every worker miss and reload them no matter how long their TTL is.
+"""
+import json
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'warehouse_changes'
+
+# Table to the columns identifying one of its rows in the notifications
+TABLE_KEYS = {
+    'co2emission_reduced': ['imo'],
+    'fact': ['ship_id', 'verifier_id', 'date_id'],
+    'ship_dim': ['ship_id'],
+    'verifier_dim': ['verifier_id'],
+    'date_dim': ['date_id'],
+}
+
+# Most row keys sent in one notification; a statement changing more rows
+# sends none, which subscribers treat as a change to any row of the table
+MAX_NOTIFY_KEYS = 100
+
+# Keys of the rows of a transition table, as JSON objects of the trigger's columns
+_ROW_KEYS = '''
+    SELECT (SELECT jsonb_object_agg(c, to_jsonb(r) -> c) FROM unnest(TG_ARGV) c) AS key FROM {rows} r
+'''
+
+CREATE_NOTIFY_FUNCTION = f'''
+    CREATE OR REPLACE FUNCTION warehouse_notify() RETURNS trigger AS $$
+    DECLARE
+        row_count BIGINT;
+        keys JSONB;
+        payload TEXT;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            SELECT count(*) INTO row_count FROM new_rows;
+        ELSE
+            SELECT count(*) INTO row_count FROM old_rows;
+        END IF;
+        IF row_count = 0 THEN
+            RETURN NULL;
+        END IF;
+
+        IF row_count <= {MAX_NOTIFY_KEYS} THEN
+            IF TG_OP = 'INSERT' THEN
+                SELECT jsonb_agg(DISTINCT key) INTO keys FROM ({_ROW_KEYS.format(rows='new_rows')}) changed;
+            ELSIF TG_OP = 'UPDATE' THEN
+                SELECT jsonb_agg(DISTINCT key) INTO keys FROM (
+                    {_ROW_KEYS.format(rows='old_rows')} UNION ALL {_ROW_KEYS.format(rows='new_rows')}
+                ) changed;
+            ELSE
+                SELECT jsonb_agg(DISTINCT key) INTO keys FROM ({_ROW_KEYS.format(rows='old_rows')}) changed;
+            END IF;
+        END IF;
+
+        -- One notification per statement; NOTIFY payloads must stay under 8000 bytes
+        payload := jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'keys', keys)::TEXT;
+        IF octet_length(payload) >= 8000 THEN
+            payload := jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'keys', NULL)::TEXT;
+        END IF;
+        PERFORM pg_notify('{CHANNEL}', payload);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+CREATE_TRIGGER = '''
+    DROP TRIGGER IF EXISTS warehouse_notify ON {table};
+    DROP TRIGGER IF EXISTS warehouse_notify_insert ON {table};
+    DROP TRIGGER IF EXISTS warehouse_notify_update ON {table};
+    DROP TRIGGER IF EXISTS warehouse_notify_delete ON {table};
+    CREATE TRIGGER warehouse_notify_insert
+    AFTER INSERT ON {table} REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE warehouse_notify({args});
+    CREATE TRIGGER warehouse_notify_update
+    AFTER UPDATE ON {table} REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE warehouse_notify({args});
+    CREATE TRIGGER warehouse_notify_delete
+    AFTER DELETE ON {table} REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE warehouse_notify({args});
+'''
+
+_subscribers = defaultdict(list)
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def install(using='default'):
+    """Creates the NOTIFY triggers on every table in TABLE_KEYS"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(CREATE_NOTIFY_FUNCTION)
+        for table, columns in TABLE_KEYS.items():
+            args = ', '.join(f"'{column}'" for column in columns)
+            cursor.execute(CREATE_TRIGGER.format(table=table, args=args))
+
+
+def _version_key(table):
+    return f'{table}-VERSION'
+
+
+def _new_version():
+    # A missing version (evicted, or the cache restarted) restarts from a
+    # value no earlier version had, so no old entry becomes valid again
+    return time.time_ns()
+
+
+def version(table):
+    """Returns the current cache version of table"""
+    return cache.get_or_set(_version_key(table), _new_version, timeout=None)
+
+
+def versioned_key(key, *tables):
+    """Returns key tagged with the versions of the tables its value is built from"""
+    return ':'.join([key, *(f'{table}.{version(table)}' for table in tables)])
+
+
+def subscribe(table, callback):
+    """
+    Calls callback(change) for every change to table, change being the
+    decoded payload: its keys are None when any row may have changed.
+    """
+    _subscribers[table].append(callback)
+
+
+def changed(table, keys=None, op=None):
+    """
+    Records a change to table in this worker. The listener calls this for
+    every notification; writers can call it directly to see their own change
+    before the notification comes back.
+    """
+    try:
+        cache.incr(_version_key(table))
+    except ValueError:
+        cache.set(_version_key(table), _new_version(), timeout=None)
+    change = {'table': table, 'op': op, 'keys': keys}
+    for callback in _subscribers[table]:
+        try:
+            callback(change)
+        except Exception:
+            logger.exception('Cache invalidation callback failed for %s', change)
+
+
+class Listener(threading.Thread):
+    """Listens on CHANNEL on its own connection to the primary database"""
+
+    def __init__(self, using='default', poll_seconds=5):
+        super().__init__(name='cache-invalidation-listener', daemon=True)
+        self.using = using
+        self.poll_seconds = poll_seconds
+        self.backoff = 1
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception('Cache invalidation listener lost its connection')
+            # Notifications sent while disconnected are lost, so start over clean
+            for table in TABLE_KEYS:
+                changed(table)
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, 60)
+
+    def listen(self):
+        conn = psycopg2.connect(**connections[self.using].get_connection_params())
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL};')
+            self.backoff = 1
+            while True:
+                if select.select([conn], [], [], self.poll_seconds) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self.dispatch(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def dispatch(self, payload):
+        try:
+            change = json.loads(payload)
+            table = change['table']
+        except (ValueError, KeyError):
+            logger.warning('Ignoring malformed change notification %r', payload)
+            return
+        changed(table, keys=change.get('keys'), op=change.get('op'))
+
+
+def start_listener(using='default'):
+    """Starts this process' listener thread, once"""
+    global _listener
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = Listener(using=using)
+            _listener.start()
+    return _listener
@@ -0,0 +1,358 @@
+"""
+Live updates of the chart and table pages over Server-Sent Events.
+
+Changes to `fact` and `co2emission_reduced` reach every worker through
+app.invalidation. The worker batches them for LIVE_DEBOUNCE_SECONDS, turns
+each batch into a few compact deltas, and sends them to all of its open
+/live/ streams. live.js applies the deltas in the browser:
+
+    extend   new points for the scatter traces (Plotly.extendTraces)
+    fit      new slope and intercept for a regression line
+    restyle  new bars or pie slices (Plotly.restyle)
+    count    new row count of a table page
+    rows     new rows of the first page of the aggregation table
+    reload   a chart that cannot be patched (fact rows updated or deleted)
+
+A page carries the versions (app.invalidation) of the tables it was built
+from, and live.js opens its stream with them. The worker keeps the last
+HISTORY_SIZE changes of each table, tagged with the version they bumped the
+table to, and first sends the deltas of the changes the page missed, or, when
+they are no longer all kept, the deltas of a change to any row. Every batch
+carries the versions it brings the page to as its event id, from which the
+browser reopens the stream. Versions only compare across workers with a
+shared CACHE_BACKEND; with a cache per worker, a stream opened on another
+worker than the page resyncs. A stream holds a server thread, so a worker
+serves at most LIVE_MAX_STREAMS of them and keeps its other threads for
+normal requests.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from app import invalidation, regression, statements
+from app.invalidation import version
+from app.routers import PRIMARY
+
+logger = logging.getLogger(__name__)
+
+# Stable ids of the chart divs on /visual/
+SCATTER_DIVS = {'co2': 'visual-co2', 'fuel': 'visual-fuel'}
+CO2_BAR_DIV = 'visual-co2-bar'
+TIME_SEA_PIE_DIV = 'visual-time-sea-pie'
+
+# Most new fact rows sent as points in one batch; more and the charts reload
+MAX_NEW_POINTS = 1000
+
+# Seconds a browser waits before retrying when this worker has no stream left
+FULL_RETRY_SECONDS = 30
+
+# Changes kept per table to catch up the streams of pages built before them
+HISTORY_SIZE = 100
+
+# The bar and pie charts of /visual/, shared with the view so both agree
+statements.register('ship_type_averages', '''
+    SELECT avg(f.total_co2), avg(f.total_time_sea), s.ship_type
+    FROM fact AS f, ship_dim AS s
+    WHERE f.ship_id = s.ship_id
+    GROUP BY s.ship_type
+''')
+
+_clients = set()
+_changes = defaultdict(list)
+_history = defaultdict(lambda: deque(maxlen=HISTORY_SIZE))
+# Version from which the history of each table holds every change
+_history_since = {}
+_lock = threading.Lock()
+_changed = threading.Event()
+_publisher = None
+
+
+def _on_change(change):
+    table = change['table']
+    # app.invalidation bumped the version before calling back
+    tag = version(table)
+    with _lock:
+        history = _history[table]
+        if not history:
+            _history_since.setdefault(table, tag - 1)
+        elif len(history) == history.maxlen:
+            _history_since[table] = history[0][0]
+        history.append((tag, change))
+        _changes[table].append((tag, change))
+        if not _clients:
+            _changes.clear()
+            return
+    _changed.set()
+
+
+invalidation.subscribe('fact', _on_change)
+invalidation.subscribe('co2emission_reduced', _on_change)
+
+
+def _new_points(cursor, keys):
+    rows = ', '.join(['(%s, %s, %s)'] * len(keys))
+    cursor.execute(f'''
+        SELECT total_time_sea, total_co2, total_fuel_consmp
+        FROM fact
+        WHERE (ship_id, verifier_id, date_id) IN ({rows});
+    ''', [value for key in keys for value in (key['ship_id'], key['verifier_id'], key['date_id'])])
+    points = np.asarray(cursor.fetchall(), dtype=float).reshape(-1, 3)
+    points = points[np.isfinite(points).all(axis=1)]
+    # The page plots log10 values, which drops non positive measurements too
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log10(points)
+    return logs[np.isfinite(logs).all(axis=1)]
+
+
+def fact_deltas(changes, using=PRIMARY):
+    deltas = []
+    inserted = [key for c in changes if c.get('op') == 'INSERT' and c.get('keys') for key in c['keys']]
+    rewritten = any(c.get('op') != 'INSERT' or not c.get('keys') for c in changes)
+
+    with connections[using].cursor() as cursor:
+        if rewritten or len(inserted) > MAX_NEW_POINTS:
+            deltas += [('reload', {'div': div}) for div in SCATTER_DIVS.values()]
+        elif inserted:
+            logs = _new_points(cursor, inserted)
+            if len(logs):
+                for column, div in [(1, SCATTER_DIVS['co2']), (2, SCATTER_DIVS['fuel'])]:
+                    deltas.append(('extend', {
+                        'div': div,
+                        'traces': [0],
+                        'x': [logs[:, 0].tolist()],
+                        'y': [logs[:, column].tolist()],
+                    }))
+
+        statements.execute(cursor, 'fact_count')
+        deltas.append(('count', {'table': 'fact', 'count': cursor.fetchone()[0]}))
+
+    fits = regression.get_fits(using=using)
+    for target, div in SCATTER_DIVS.items():
+        if fits[target] is not None:
+            deltas.append(('fit', {
+                'div': div,
+                'trace': 1,
+                'slope': fits[target].slope,
+                'intercept': fits[target].intercept,
+            }))
+
+    with connections[using].cursor() as cursor:
+        statements.execute(cursor, 'ship_type_averages')
+        by_type = cursor.fetchall()
+    ship_types = [ship_type for _, _, ship_type in by_type]
+    deltas.append(('restyle', {
+        'div': CO2_BAR_DIV,
+        'traces': [0],
+        'update': {'x': [ship_types], 'y': [[_jsonable(co2) for co2, _, _ in by_type]]},
+    }))
+    deltas.append(('restyle', {
+        'div': TIME_SEA_PIE_DIV,
+        'traces': [0],
+        'update': {'labels': [ship_types], 'values': [[_jsonable(time_sea) for _, time_sea, _ in by_type]]},
+    }))
+    return deltas
+
+
+def emission_deltas(changes, using=PRIMARY):
+    page_size = getattr(settings, 'LIVE_AGGREGATION_ROWS', 20)
+    with connections[using].cursor() as cursor:
+        statements.execute(cursor, 'co2emission_reduced_count')
+        count = cursor.fetchone()[0]
+        statements.execute(cursor, 'aggregation_page', [0, page_size])
+        rows = [[_jsonable(value) for value in row] for row in cursor.fetchall()]
+    return [
+        ('count', {'table': 'co2emission_reduced', 'count': count}),
+        # First page only; live.js ignores it on the other pages
+        ('rows', {'table': 'aggregation', 'page': 1, 'rows': rows}),
+    ]
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return float(value)
+
+
+DELTA_BUILDERS = {
+    'fact': fact_deltas,
+    'co2emission_reduced': emission_deltas,
+}
+
+
+def format_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def format_since(versions):
+    """Returns {table: version} as the since parameter and event id of a stream"""
+    return ','.join(f'{table}.{version}' for table, version in versions.items())
+
+
+def parse_since(value):
+    """Returns the {table: version} of a since parameter, ignoring unknown tables"""
+    versions = {}
+    for part in (value or '').split(','):
+        table, _, version = part.rpartition('.')
+        if table in DELTA_BUILDERS and version.isdigit():
+            versions[table] = int(version)
+    return versions
+
+
+def _with_id(events, versions):
+    if not events or not versions:
+        return events
+    return [*events[:-1], f'id: {format_since(versions)}\n{events[-1]}']
+
+
+def _build_events(table, changes, resync=False):
+    try:
+        deltas = DELTA_BUILDERS[table](changes)
+    except DatabaseError:
+        logger.exception('Could not build the live deltas of %s', table)
+        return []
+    # Catching up reloads a chart at most once in a while (live.js)
+    return [
+        format_event(name, {**data, 'resync': True} if resync and name == 'reload' else data)
+        for name, data in deltas
+    ]
+
+
+def publish(events, versions=None, clients=None):
+    """
+    Sends the formatted events to every (or each of the given) open stream of
+    this worker, the last one with the versions they bring the streams to as
+    its id.
+    """
+    if clients is None:
+        with _lock:
+            clients = list(_clients)
+    for client in clients:
+        if versions:
+            client.since.update(versions)
+        for event in _with_id(events, client.since if versions else None):
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                # A stream that cannot keep up is closed; the browser reconnects
+                client.overflowed = True
+                break
+
+
+def _run_publisher():
+    while True:
+        _changed.wait()
+        time.sleep(getattr(settings, 'LIVE_DEBOUNCE_SECONDS', 1))
+        _changed.clear()
+        with _lock:
+            batch = dict(_changes)
+            _changes.clear()
+            # Streams opened since then caught up with the batch already
+            clients = list(_clients)
+        events = []
+        for table, changes in batch.items():
+            events += _build_events(table, [change for _, change in changes])
+        connections.close_all()
+        if events:
+            publish(events, {table: changes[-1][0] for table, changes in batch.items()}, clients)
+
+
+def _start_publisher():
+    global _publisher
+    with _lock:
+        if _publisher is None:
+            _publisher = threading.Thread(target=_run_publisher, name='live-publisher', daemon=True)
+            _publisher.start()
+
+
+class _Client(queue.Queue):
+    overflowed = False
+
+    def __init__(self, since, **kwargs):
+        super().__init__(**kwargs)
+        # Versions of the tables the page has caught up with
+        self.since = since
+        self.catch_up = []
+
+
+def _max_streams():
+    return getattr(settings, 'LIVE_MAX_STREAMS', 4)
+
+
+def _events(client):
+    heartbeat = getattr(settings, 'LIVE_HEARTBEAT_SECONDS', 15)
+    deadline = time.monotonic() + getattr(settings, 'LIVE_STREAM_SECONDS', 5 * 60)
+    yield 'retry: 5000\n\n'
+    yield from client.catch_up
+    while time.monotonic() < deadline and not client.overflowed:
+        try:
+            yield client.get(timeout=heartbeat)
+        except queue.Empty:
+            yield ': keep-alive\n\n'
+
+
+class _Stream:
+    """The events of one stream; closing it frees its place, even if it never started"""
+
+    def __init__(self, client):
+        self.client = client
+        self.events = _events(client)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.events)
+
+    def close(self):
+        self.events.close()
+        with _lock:
+            _clients.discard(self.client)
+
+
+def _missed(table, since):
+    """
+    Returns the changes to table made after version since, whether they are
+    all kept, and the version they bring the table to. Called under _lock.
+    """
+    current = version(table)
+    if since == current:
+        return [], True, since
+    history = _history[table]
+    if _history_since.get(table, current) <= since <= current:
+        changes = [(tag, change) for tag, change in history if tag > since]
+        return [change for _, change in changes], True, changes[-1][0] if changes else since
+    return [], False, current
+
+
+def stream(since=None):
+    """
+    Returns the Server-Sent Events of a new /live/ connection, or None if
+    this worker already serves LIVE_MAX_STREAMS. since, the {table: version}
+    the page was built from, first brings the page up to date. The events
+    are the deltas, and a comment every LIVE_HEARTBEAT_SECONDS to keep
+    proxies from closing the stream. It ends after LIVE_STREAM_SECONDS and
+    the browser opens a new one.
+    """
+    with _lock:
+        if len(_clients) >= _max_streams():
+            return None
+        missed = {table: _missed(table, table_since) for table, table_since in (since or {}).items()}
+        client = _Client({table: tag for table, (_, _, tag) in missed.items()}, maxsize=100)
+        _clients.add(client)
+    events = []
+    for table, (changes, kept, _) in missed.items():
+        if not kept:
+            # Too old a page, or one from another cache: resend everything
+            changes = [{'table': table, 'op': None, 'keys': None}]
+        if changes:
+            events += _build_events(table, changes, resync=True)
+    client.catch_up = _with_id(events, client.since)
+    _start_publisher()
+    return _Stream(client)
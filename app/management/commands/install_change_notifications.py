@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app import invalidation
+
+
+class Command(BaseCommand):
+    help = 'Creates the triggers that NOTIFY the workers of changes to the warehouse tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        invalidation.install(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Change notifications installed on {", ".join(invalidation.TABLE_KEYS)}'
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app import cube
+
+
+class Command(BaseCommand):
+    help = 'Creates the fact cube table and trigger, then rebuilds it from fact'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        cube.install(using=options['database'])
+        cube.rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS('Fact cube rebuilt'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app import sketches
+
+
+class Command(BaseCommand):
+    help = 'Creates the EEDI sketch tables and trigger, then rebuilds every sketch from fact'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        sketches.install(using=options['database'])
+        sketches.rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS('EEDI sketches rebuilt'))
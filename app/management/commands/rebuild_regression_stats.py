@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app import regression
+
+
+class Command(BaseCommand):
+    help = 'Creates the regression stats table and trigger, then rebuilds it from fact'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        regression.install(using=options['database'])
+        regression.rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS('Regression stats rebuilt'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app import topk
+
+
+class Command(BaseCommand):
+    help = 'Creates the ship top-k table and trigger for SHIP_TOPK_K, then rebuilds it from fact'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        topk.install(using=options['database'])
+        topk.rebuild(using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f'Ship top-{topk.get_k()} rebuilt'))
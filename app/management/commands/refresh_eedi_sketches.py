@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app import sketches
+
+
+class Command(BaseCommand):
+    help = 'Folds the queued EEDI values into the sketches and rebuilds stale cells'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if sketches.refresh(using=options['database']):
+            self.stdout.write(self.style.SUCCESS('EEDI sketches refreshed'))
+        else:
+            self.stdout.write('EEDI sketches were up to date')
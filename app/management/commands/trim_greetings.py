@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app import greetings
+
+
+class Command(BaseCommand):
+    help = 'Deletes the app_greeting rows older than GREETING_RETENTION_DAYS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Keep this many days instead')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        deleted = greetings.trim(days=options['days'], using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} greetings'))
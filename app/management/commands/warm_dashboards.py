@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app import dashboards
+# Importing the views registers the dashboards
+import app.views  # noqa: F401
+
+
+class Command(BaseCommand):
+    help = 'Builds and caches every chart page whose cached copy is missing or stale'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Dashboards to warm (default: all)')
+
+    def handle(self, *args, **options):
+        if settings.CACHES['default']['BACKEND'].endswith('LocMemCache'):
+            # The pages would be built into this command's own memory
+            raise CommandError('warm_dashboards needs a cache shared with the web workers (CACHE_BACKEND)')
+        built = dashboards.warm(options['names'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Warmed {", ".join(built)}' if built else 'All dashboards were already fresh'
+        ))
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.8 on 2026-10-19 14:49
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # The table may be large by now, so build the index without blocking inserts
+    atomic = False
+
+    dependencies = [
+        ('app', '0003_alter_greeting_id'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='greeting',
+            index=models.Index(fields=['when'], name='app_greeting_when_idx'),
+        ),
+    ]
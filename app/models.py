@@ -5,3 +5,6 @@ from django.db import models
 class Greeting(models.Model):
     id = models.AutoField(primary_key=True)
     when = models.DateTimeField("date created", auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['when'], name='app_greeting_when_idx')]
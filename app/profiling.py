@@ -0,0 +1,305 @@
+"""
+Per-request sampling profiler.
+
+A request is profiled when it carries a signed token (`?profile=<token>` or an
+`X-Profile` header, see `make_token()`), or at random with probability
+settings.PROFILE_SAMPLE_RATE. While it runs, a sampler thread records the
+request thread's Python stack every PROFILE_INTERVAL_MS milliseconds and an
+execute wrapper records every SQL query with its start time and duration.
+
+Captures are written to settings.PROFILE_DIR as speedscope files
+(https://www.speedscope.app) holding the stack samples and the SQL timeline,
+plus a small metadata file for the admin page. The oldest captures are deleted
+once the directory grows past PROFILE_MAX_BYTES.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core import signing
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SALT = 'app.profiling'
+QUERY_PARAM = 'profile'
+HEADER = 'HTTP_X_PROFILE'
+RESPONSE_HEADER = 'X-Profile-Id'
+
+# Longest SQL text kept per query in a capture
+MAX_SQL_LENGTH = 500
+
+_write_lock = threading.Lock()
+
+
+def make_token():
+    """Returns a token enabling profiling for PROFILE_TOKEN_MAX_AGE seconds"""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+def _valid_token(token):
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+            token, max_age=getattr(settings, 'PROFILE_TOKEN_MAX_AGE', 60 * 60))
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def should_profile(request):
+    token = request.GET.get(QUERY_PARAM) or request.META.get(HEADER)
+    if token:
+        return _valid_token(token)
+    rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def profile_dir():
+    return getattr(settings, 'PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of thread_id every interval seconds. Frames above (and
+    including) root_code are left out, so stacks start at the profiled code.
+    """
+
+    def __init__(self, thread_id, interval, root_code=None):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root_code = root_code
+        self.samples = []  # (seconds since the previous sample, stack)
+        self._done = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and frame.f_code is not self.root_code:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append((now - last, tuple(stack)))
+            last = now
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+class QueryTimeline:
+    """Execute wrapper recording the queries run on the connections it is installed on"""
+
+    def __init__(self, start):
+        self.start = start
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'alias': context['connection'].alias,
+                'sql': ' '.join(sql.split())[:MAX_SQL_LENGTH],
+                'many': many,
+                'start_ms': (started - self.start) * 1000,
+                'duration_ms': (time.perf_counter() - started) * 1000,
+            })
+
+
+def to_speedscope(name, samples, queries, duration_ms):
+    """Returns a speedscope document with a sampled CPU profile and an evented SQL profile"""
+    frames, frame_index = [], {}
+
+    def index(key, frame):
+        if key not in frame_index:
+            frame_index[key] = len(frames)
+            frames.append(frame)
+        return frame_index[key]
+
+    stacks, weights = [], []
+    for elapsed, stack in samples:
+        stacks.append([
+            index((func, filename), {'name': func, 'file': filename, 'line': line})
+            for func, filename, line in stack
+        ])
+        weights.append(elapsed * 1000)
+
+    events = []
+    for query in queries:
+        frame = index(('sql', query['alias'], query['sql']), {'name': f"[{query['alias']}] {query['sql']}"})
+        events.append({'type': 'O', 'frame': frame, 'at': query['start_ms']})
+        events.append({'type': 'C', 'frame': frame, 'at': query['start_ms'] + query['duration_ms']})
+
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'app.profiling',
+        'shared': {'frames': frames},
+        'profiles': [
+            {
+                'type': 'sampled',
+                'name': f'{name} (Python stacks)',
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': duration_ms,
+                'samples': stacks,
+                'weights': weights,
+            },
+            {
+                'type': 'evented',
+                'name': f'{name} (SQL)',
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': duration_ms,
+                'events': events,
+            },
+        ],
+    }
+
+
+def to_folded(document):
+    """Converts the sampled profile of a speedscope document to folded stacks for flamegraph.pl"""
+    frames = document['shared']['frames']
+    sampled = document['profiles'][0]
+    totals = {}
+    for stack, weight in zip(sampled['samples'], sampled['weights']):
+        key = ';'.join(f"{frames[i]['name']} ({os.path.basename(frames[i]['file'])})" for i in stack)
+        totals[key] = totals.get(key, 0) + weight
+    # flamegraph.pl wants integer counts, so weigh stacks in microseconds
+    return ''.join(f'{stack} {round(weight * 1000)}\n' for stack, weight in totals.items() if stack)
+
+
+def _paths(capture_id):
+    base = os.path.join(profile_dir(), capture_id)
+    return f'{base}.meta.json', f'{base}.speedscope.json'
+
+
+def save(meta, document):
+    """Writes a capture and trims the directory to PROFILE_MAX_BYTES"""
+    meta_path, document_path = _paths(meta['id'])
+    with _write_lock:
+        os.makedirs(profile_dir(), exist_ok=True)
+        with open(document_path, 'w') as f:
+            json.dump(document, f, separators=(',', ':'))
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        enforce_retention()
+
+
+def enforce_retention(max_bytes=None):
+    """Deletes the oldest captures until the directory is under max_bytes"""
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'PROFILE_MAX_BYTES', 50 * 1024 * 1024)
+    captures = {}
+    for entry in os.scandir(profile_dir()):
+        capture_id = entry.name.split('.', 1)[0]
+        size, mtime = captures.get(capture_id, (0, 0))
+        stat = entry.stat()
+        captures[capture_id] = (size + stat.st_size, max(mtime, stat.st_mtime))
+    total = sum(size for size, mtime in captures.values())
+    for capture_id, (size, mtime) in sorted(captures.items(), key=lambda item: item[1][1]):
+        if total <= max_bytes:
+            break
+        delete(capture_id)
+        total -= size
+
+
+def delete(capture_id):
+    for path in _paths(capture_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def list_captures():
+    """Returns the metadata of every stored capture, newest first"""
+    try:
+        entries = [entry.path for entry in os.scandir(profile_dir()) if entry.name.endswith('.meta.json')]
+    except FileNotFoundError:
+        return []
+    captures = []
+    for path in entries:
+        try:
+            with open(path) as f:
+                captures.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(captures, key=lambda meta: meta['started'], reverse=True)
+
+
+def load(capture_id):
+    """Returns the speedscope document of a capture, raising FileNotFoundError if there is none"""
+    # Ids are generated by us, anything else could be a path
+    uuid.UUID(capture_id)
+    with open(_paths(capture_id)[1]) as f:
+        return json.load(f)
+
+
+class ProfilingMiddleware:
+    """Profiles the requests selected by should_profile() and stores the captures"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not should_profile(request):
+            return self.get_response(request)
+        return self.profile(request)
+
+    def profile(self, request):
+        capture_id = str(uuid.uuid4())
+        started = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        timeline = QueryTimeline(start)
+        sampler = StackSampler(
+            threading.get_ident(),
+            getattr(settings, 'PROFILE_INTERVAL_MS', 5) / 1000,
+            root_code=ProfilingMiddleware.profile.__code__,
+        )
+        response = None
+        sampler.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timeline))
+                response = self.get_response(request)
+        finally:
+            sampler.stop()
+            duration_ms = (time.perf_counter() - start) * 1000
+            name = f'{request.method} {request.path}'
+            query = request.GET.copy()
+            query.pop(QUERY_PARAM, None)
+            meta = {
+                'id': capture_id,
+                'started': started.isoformat(),
+                'method': request.method,
+                'path': f'{request.path}?{query.urlencode()}' if query else request.path,
+                'status': response.status_code if response is not None else None,
+                'duration_ms': duration_ms,
+                'samples': len(sampler.samples),
+                'queries': len(timeline.queries),
+                'sql_ms': sum(query['duration_ms'] for query in timeline.queries),
+            }
+            try:
+                save(meta, to_speedscope(name, sampler.samples, timeline.queries, duration_ms))
+            except OSError:
+                logger.exception('Could not store profile %s', capture_id)
+        response[RESPONSE_HEADER] = capture_id
+        return response
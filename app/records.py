@@ -0,0 +1,121 @@
+"""
+Write-through cache of co2emission_reduced rows by IMO, for the detail page.
+
+Reads fill the cache, unknown IMOs included (as MISSING, for
+RECORD_NEGATIVE_TTL seconds) so repeated 404s do not reach the database.
+Writers call `written()` inside their transaction. Once it commits, the new
+row (or MISSING after a delete) is stored in the cache of the writing
+worker, and the change is announced through app.invalidation. Every worker,
+the writer included, evicts the IMO when its NOTIFY arrives; for the writer
+that only costs one miss. Misses are read from
+the primary: a lagging replica could otherwise cache an old row for
+RECORD_CACHE_TTL seconds, or a 404 for a just inserted IMO.
+"""
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+
+from app import invalidation, statements
+from app.routers import PRIMARY
+from app.utils import namedtuplefetchall
+
+TABLE = 'co2emission_reduced'
+MISSING = 'MISSING'
+GENERATION_KEY = 'imo-record-GENERATION'
+
+statements.register('record_by_imo', f'SELECT * FROM {TABLE} WHERE imo = %s')
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def _key(imo):
+    generation = cache.get_or_set(GENERATION_KEY, time.time_ns, timeout=None)
+    return f'imo-record:{generation}:{int(imo)}'
+
+
+def _positive_ttl():
+    return getattr(settings, 'RECORD_CACHE_TTL', 5 * 60)
+
+
+def _negative_ttl():
+    return getattr(settings, 'RECORD_NEGATIVE_TTL', 60)
+
+
+def get(imo, using=PRIMARY):
+    """Returns the row of imo as a dict, or None if there is no such IMO"""
+    key = _key(imo)
+    row = cache.get(key)
+    if row == MISSING:
+        _count('negative_hits')
+        return None
+    if row is not None:
+        _count('hits')
+        return dict(row)
+
+    _count('misses')
+    with connections[using].cursor() as cursor:
+        statements.execute(cursor, 'record_by_imo', [imo])
+        rows = namedtuplefetchall(cursor)
+    if not rows:
+        cache.set(key, MISSING, timeout=_negative_ttl())
+        return None
+    row = rows[0]._asdict()
+    cache.set(key, row, timeout=_positive_ttl())
+    return dict(row)
+
+
+def written(imo, row, op, using='default'):
+    """
+    Records that the current transaction on using wrote imo: row is its new
+    value as a dict, or None if it was deleted. Takes effect on commit.
+    """
+    def on_commit():
+        invalidation.changed(TABLE, [{'imo': int(imo)}], op)
+        if row is None:
+            cache.set(_key(imo), MISSING, timeout=_negative_ttl())
+        else:
+            cache.set(_key(imo), dict(row), timeout=_positive_ttl())
+
+    transaction.on_commit(on_commit, using=using)
+
+
+def _on_change(change):
+    keys = change.get('keys')
+    if keys is None or any(key.get('imo') is None for key in keys):
+        # Unknown rows changed (e.g. a bulk load, or the listener
+        # reconnected): drop them all
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            # Never back to a generation older entries were stored under
+            cache.set(GENERATION_KEY, time.time_ns(), timeout=None)
+        return
+    for key in keys:
+        cache.delete(_key(key['imo']))
+
+
+invalidation.subscribe(TABLE, _on_change)
+
+
+def stats():
+    """Returns the hit counters of this process"""
+    with _lock:
+        counters = dict(_counters)
+    lookups = sum(counters.get(name, 0) for name in ('hits', 'negative_hits', 'misses'))
+    hits = counters.get('hits', 0) + counters.get('negative_hits', 0)
+    return {
+        'hits': counters.get('hits', 0),
+        'negative_hits': counters.get('negative_hits', 0),
+        'misses': counters.get('misses', 0),
+        'hit_rate': hits / lookups if lookups else None,
+    }
@@ -0,0 +1,232 @@
+"""
+Running sufficient statistics for the log10 regressions shown on /visual/.
+
+For every (ship_type, year) cell we keep n, sum(x), sum(x^2) and, for both
+targets (total co2 and total fuel consumption), sum(y), sum(y^2) and
+sum(x*y), where x = log10(total_time_sea). A trigger on `fact` keeps the
+sums up to date, so a fit over any set of cells is a handful of additions
+instead of a scan of the whole fact table.
+"""
+from collections import namedtuple
+
+import numpy as np
+from django.db import connections, transaction
+
+TARGETS = ['co2', 'fuel']
+
+CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS fact_regression_stats (
+        ship_type TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        n BIGINT NOT NULL DEFAULT 0,
+        sum_x DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sum_xx DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sum_co2 DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sum_co2_sq DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sum_x_co2 DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sum_fuel DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sum_fuel_sq DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sum_x_fuel DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (ship_type, year)
+    );
+'''
+
+CREATE_ADD_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION fact_regression_stats_add(
+        p_ship_type TEXT, p_year INTEGER,
+        p_tts DOUBLE PRECISION, p_co2 DOUBLE PRECISION, p_fuel DOUBLE PRECISION,
+        p_sign INTEGER
+    ) RETURNS void AS $$
+    DECLARE
+        x DOUBLE PRECISION;
+        co2 DOUBLE PRECISION;
+        fuel DOUBLE PRECISION;
+    BEGIN
+        -- Rows that cannot be log-transformed are left out of the fit
+        IF p_ship_type IS NULL OR p_year IS NULL
+           OR COALESCE(p_tts, 0) <= 0 OR COALESCE(p_co2, 0) <= 0
+           OR COALESCE(p_fuel, 0) <= 0 THEN
+            RETURN;
+        END IF;
+        x := log(p_tts);
+        co2 := log(p_co2);
+        fuel := log(p_fuel);
+        INSERT INTO fact_regression_stats AS s VALUES (
+            p_ship_type, p_year, p_sign,
+            p_sign * x, p_sign * x * x,
+            p_sign * co2, p_sign * co2 * co2, p_sign * x * co2,
+            p_sign * fuel, p_sign * fuel * fuel, p_sign * x * fuel
+        )
+        ON CONFLICT (ship_type, year) DO UPDATE SET
+            n = s.n + EXCLUDED.n,
+            sum_x = s.sum_x + EXCLUDED.sum_x,
+            sum_xx = s.sum_xx + EXCLUDED.sum_xx,
+            sum_co2 = s.sum_co2 + EXCLUDED.sum_co2,
+            sum_co2_sq = s.sum_co2_sq + EXCLUDED.sum_co2_sq,
+            sum_x_co2 = s.sum_x_co2 + EXCLUDED.sum_x_co2,
+            sum_fuel = s.sum_fuel + EXCLUDED.sum_fuel,
+            sum_fuel_sq = s.sum_fuel_sq + EXCLUDED.sum_fuel_sq,
+            sum_x_fuel = s.sum_x_fuel + EXCLUDED.sum_x_fuel;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+CREATE_TRIGGER_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION fact_regression_stats_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM fact_regression_stats_add(
+                (SELECT s.ship_type::TEXT FROM ship_dim s WHERE s.ship_id = OLD.ship_id),
+                (SELECT d.year::INTEGER FROM date_dim d WHERE d.date_id = OLD.date_id),
+                OLD.total_time_sea::DOUBLE PRECISION,
+                OLD.total_co2::DOUBLE PRECISION,
+                OLD.total_fuel_consmp::DOUBLE PRECISION,
+                -1
+            );
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM fact_regression_stats_add(
+                (SELECT s.ship_type::TEXT FROM ship_dim s WHERE s.ship_id = NEW.ship_id),
+                (SELECT d.year::INTEGER FROM date_dim d WHERE d.date_id = NEW.date_id),
+                NEW.total_time_sea::DOUBLE PRECISION,
+                NEW.total_co2::DOUBLE PRECISION,
+                NEW.total_fuel_consmp::DOUBLE PRECISION,
+                1
+            );
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+CREATE_TRIGGER = '''
+    DROP TRIGGER IF EXISTS fact_regression_stats ON fact;
+    CREATE TRIGGER fact_regression_stats
+    AFTER INSERT OR UPDATE OR DELETE ON fact
+    FOR EACH ROW EXECUTE PROCEDURE fact_regression_stats_trigger();
+'''
+
+REBUILD = '''
+    INSERT INTO fact_regression_stats
+    SELECT s.ship_type, d.year, COUNT(*),
+           SUM(log(f.total_time_sea)), SUM(log(f.total_time_sea) ^ 2),
+           SUM(log(f.total_co2)), SUM(log(f.total_co2) ^ 2),
+           SUM(log(f.total_time_sea) * log(f.total_co2)),
+           SUM(log(f.total_fuel_consmp)), SUM(log(f.total_fuel_consmp) ^ 2),
+           SUM(log(f.total_time_sea) * log(f.total_fuel_consmp))
+    FROM (
+        SELECT ship_id, date_id,
+               total_time_sea::DOUBLE PRECISION AS total_time_sea,
+               total_co2::DOUBLE PRECISION AS total_co2,
+               total_fuel_consmp::DOUBLE PRECISION AS total_fuel_consmp
+        FROM fact
+        WHERE total_time_sea > 0 AND total_co2 > 0 AND total_fuel_consmp > 0
+    ) f, ship_dim s, date_dim d
+    WHERE f.ship_id = s.ship_id AND f.date_id = d.date_id
+    GROUP BY s.ship_type, d.year;
+'''
+
+SUM_COLUMNS = [
+    'n',
+    'sum_x',
+    'sum_xx',
+    'sum_co2',
+    'sum_co2_sq',
+    'sum_x_co2',
+    'sum_fuel',
+    'sum_fuel_sq',
+    'sum_x_fuel',
+]
+
+
+class Fit(namedtuple('Fit', ['n', 'slope', 'intercept', 'r2'])):
+    """Least squares fit of log10(target) against log10(total time at sea)"""
+
+    def predict(self, x):
+        return self.intercept + self.slope * np.asarray(x, dtype=float)
+
+
+def fit_from_sums(n, sum_x, sum_y, sum_xx, sum_xy, sum_yy):
+    """
+    Returns the least squares Fit described by the running sums,
+    or None if there are not enough distinct points to fit a line.
+    """
+    if n < 2:
+        return None
+    sxx = sum_xx - sum_x * sum_x / n
+    sxy = sum_xy - sum_x * sum_y / n
+    syy = sum_yy - sum_y * sum_y / n
+    if sxx <= 0:
+        return None
+    slope = sxy / sxx
+    intercept = (sum_y - slope * sum_x) / n
+    r2 = sxy * sxy / (sxx * syy) if syy > 0 else 1.0
+    return Fit(int(n), slope, intercept, r2)
+
+
+def _fits(row):
+    n, sum_x, sum_xx = row[0], row[1], row[2]
+    return {
+        'co2': fit_from_sums(n, sum_x, row[3], sum_xx, row[5], row[4]),
+        'fuel': fit_from_sums(n, sum_x, row[6], sum_xx, row[8], row[7]),
+    }
+
+
+def _where(ship_type, year):
+    conditions, params = [], []
+    if ship_type is not None:
+        conditions.append('ship_type = %s')
+        params.append(ship_type)
+    if year is not None:
+        conditions.append('year = %s')
+        params.append(year)
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    return where, params
+
+
+def get_fits(ship_type=None, year=None, using='default'):
+    """
+    Returns a dict with the 'co2' and 'fuel' fits over all cells matching
+    ship_type and year (None meaning all of them).
+    """
+    where, params = _where(ship_type, year)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'''
+            SELECT {", ".join(f"COALESCE(SUM({col}), 0)::DOUBLE PRECISION" for col in SUM_COLUMNS)}
+            FROM fact_regression_stats
+            {where}
+        ''', params)
+        return _fits(cursor.fetchone())
+
+
+def fits_by_ship_type(year=None, using='default'):
+    """Returns a dict of ship_type to its 'co2' and 'fuel' fits"""
+    where, params = _where(None, year)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'''
+            SELECT ship_type, {", ".join(f"SUM({col})::DOUBLE PRECISION" for col in SUM_COLUMNS)}
+            FROM fact_regression_stats
+            {where}
+            GROUP BY ship_type
+            ORDER BY ship_type
+        ''', params)
+        return {row[0]: _fits(row[1:]) for row in cursor.fetchall()}
+
+
+def install(using='default'):
+    """Creates the stats table and the trigger keeping it up to date"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(CREATE_TABLE)
+        cursor.execute(CREATE_ADD_FUNCTION)
+        cursor.execute(CREATE_TRIGGER_FUNCTION)
+        cursor.execute(CREATE_TRIGGER)
+
+
+def rebuild(using='default'):
+    """Recomputes every cell of the stats table from the fact table"""
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            # Block writes to fact so the trigger cannot race the rebuild
+            cursor.execute('LOCK TABLE fact IN SHARE MODE;')
+            cursor.execute('DELETE FROM fact_regression_stats;')
+            cursor.execute(REBUILD)
@@ -0,0 +1,90 @@
+"""
+Primary/replica routing with read-your-writes pinning.
+
+Views ask `read_db()` for the alias to run SELECTs on and `write_db()` for
+the alias to write to. Reads go to one of settings.DATABASE_REPLICAS unless
+the current request is pinned to the primary, which happens for non-safe
+methods, after a write in the same request, and for a short window
+(settings.REPLICA_PIN_SECONDS) after a write by the same browser, so a
+redirect right after an insert still sees the new row.
+"""
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+PRIMARY = 'default'
+PIN_COOKIE = 'primary_pin'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def read_db():
+    """Returns the database alias the current request should read from"""
+    if getattr(_state, 'pinned', False) or not replicas():
+        return PRIMARY
+    return random.choice(replicas())
+
+
+@contextmanager
+def use_primary():
+    """Makes read_db() return the primary inside the block, e.g. for background jobs"""
+    pinned = getattr(_state, 'pinned', False)
+    _state.pinned = True
+    try:
+        yield
+    finally:
+        _state.pinned = pinned
+
+
+def write_db():
+    """Returns the primary alias and pins the rest of the request (and session) to it"""
+    _state.pinned = True
+    _state.wrote = True
+    return PRIMARY
+
+
+class PrimaryReplicaRouter:
+    """Applies the same rules to ORM queries"""
+
+    def db_for_read(self, model, **hints):
+        return read_db()
+
+    def db_for_write(self, model, **hints):
+        return write_db()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
+
+
+class PrimaryPinningMiddleware:
+    """Tracks whether a request must read from the primary and sets the pin cookie after writes"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.pinned = request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+            if _state.wrote:
+                response.set_cookie(
+                    PIN_COOKIE, '1',
+                    max_age=getattr(settings, 'REPLICA_PIN_SECONDS', 5),
+                    httponly=True,
+                    samesite='Lax',
+                )
+            return response
+        finally:
+            _state.pinned = False
+            _state.wrote = False
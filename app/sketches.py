@@ -0,0 +1,375 @@
+"""
+Mergeable EEDI quantile sketches (t-digest) per (year, ship_type) cell.
+
+Inserts into `fact` are queued by a trigger in `eedi_sketch_pending`. Updates
+and deletes cannot be subtracted from a sketch, so they mark the cell stale
+and it is rebuilt from `fact` for that cell only. `refresh()` does both on
+the primary (`manage.py refresh_eedi_sketches`, run by the scheduler); until
+then readers merge the queue and the stale cells into what they load,
+without writing, so they can read from a replica. Roll-up levels (per year, overall)
+are answered by merging the cell sketches, so any percentile costs a merge of
+a few hundred centroids instead of a sort of the eedi column.
+"""
+import math
+import struct
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, transaction
+
+# Key used with pg_advisory_xact_lock so only one worker folds pending rows
+REFRESH_LOCK = 5110027
+
+HEADER = struct.Struct('<dddI')
+
+CREATE_TABLES = '''
+    CREATE TABLE IF NOT EXISTS eedi_sketch (
+        year INTEGER NOT NULL,
+        ship_type TEXT NOT NULL,
+        sketch BYTEA,
+        stale BOOLEAN NOT NULL DEFAULT FALSE,
+        PRIMARY KEY (year, ship_type)
+    );
+    CREATE TABLE IF NOT EXISTS eedi_sketch_pending (
+        id BIGSERIAL PRIMARY KEY,
+        year INTEGER NOT NULL,
+        ship_type TEXT NOT NULL,
+        eedi DOUBLE PRECISION NOT NULL
+    );
+'''
+
+CREATE_TRIGGER_FUNCTION = '''
+    CREATE OR REPLACE FUNCTION eedi_sketch_trigger() RETURNS trigger AS $$
+    DECLARE
+        cell_year INTEGER;
+        cell_type TEXT;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            IF NEW.eedi IS NOT NULL THEN
+                INSERT INTO eedi_sketch_pending (year, ship_type, eedi)
+                SELECT d.year, s.ship_type, NEW.eedi
+                FROM ship_dim s, date_dim d
+                WHERE s.ship_id = NEW.ship_id AND d.date_id = NEW.date_id;
+            END IF;
+            RETURN NULL;
+        END IF;
+
+        IF TG_OP = 'UPDATE' AND NEW.eedi IS NOT DISTINCT FROM OLD.eedi
+           AND NEW.ship_id = OLD.ship_id AND NEW.date_id = OLD.date_id THEN
+            RETURN NULL;
+        END IF;
+
+        -- Values cannot be removed from a sketch, so rebuild the cell(s) lazily
+        INSERT INTO eedi_sketch (year, ship_type, stale)
+        SELECT d.year, s.ship_type, TRUE
+        FROM ship_dim s, date_dim d
+        WHERE s.ship_id = OLD.ship_id AND d.date_id = OLD.date_id
+        ON CONFLICT (year, ship_type) DO UPDATE SET stale = TRUE;
+        IF TG_OP = 'UPDATE' THEN
+            INSERT INTO eedi_sketch (year, ship_type, stale)
+            SELECT d.year, s.ship_type, TRUE
+            FROM ship_dim s, date_dim d
+            WHERE s.ship_id = NEW.ship_id AND d.date_id = NEW.date_id
+            ON CONFLICT (year, ship_type) DO UPDATE SET stale = TRUE;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+CREATE_TRIGGER = '''
+    DROP TRIGGER IF EXISTS eedi_sketch ON fact;
+    CREATE TRIGGER eedi_sketch
+    AFTER INSERT OR UPDATE OR DELETE ON fact
+    FOR EACH ROW EXECUTE PROCEDURE eedi_sketch_trigger();
+'''
+
+CELL_VALUES = '''
+    SELECT d.year, s.ship_type, f.eedi
+    FROM fact f, ship_dim s, date_dim d
+    WHERE f.ship_id = s.ship_id AND f.date_id = d.date_id AND f.eedi IS NOT NULL
+'''
+
+
+def compression_for(rank_error):
+    """
+    Returns the t-digest compression whose centroids are small enough to keep
+    the rank error of any quantile estimate below rank_error.
+    """
+    # A centroid around quantile q spans at most pi * sqrt(q(1 - q)) / delta
+    # of the ranks, i.e. pi / (2 * delta) either side of its mean in the worst case
+    return max(20, math.ceil(math.pi / (2 * rank_error)))
+
+
+def default_compression():
+    return compression_for(getattr(settings, 'EEDI_SKETCH_RANK_ERROR', 0.01))
+
+
+class TDigest:
+    """Merging t-digest with the arcsine (k1) scale function"""
+
+    def __init__(self, compression=None):
+        self.compression = compression or default_compression()
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    @property
+    def count(self):
+        self._flush()
+        return int(self.weights.sum())
+
+    def add(self, value):
+        value = float(value)
+        self._buffer.append(value)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= 5 * self.compression:
+            self._flush()
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Merges other into this digest and returns it"""
+        other._flush()
+        self._flush()
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(
+            np.concatenate([self.means, other.means]),
+            np.concatenate([self.weights, other.weights]),
+        )
+        return self
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        buffered = np.asarray(self._buffer, dtype=float)
+        self._buffer = []
+        self._compress(
+            np.concatenate([self.means, buffered]),
+            np.concatenate([self.weights, np.ones(len(buffered))]),
+        )
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q_limit(self, q):
+        k = self._k(q) + 1
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(2 * math.pi * k / self.compression) + 1) / 2
+
+    def _compress(self, means, weights):
+        if not len(means):
+            self.means, self.weights = means, weights
+            return
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+
+        out_means, out_weights = [], []
+        cur_mean, cur_weight = means[0], weights[0]
+        so_far = 0.0
+        q_limit = self._q_limit(0.0)
+        for mean, weight in zip(means[1:], weights[1:]):
+            if (so_far + cur_weight + weight) / total <= q_limit:
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / cur_weight
+            else:
+                out_means.append(cur_mean)
+                out_weights.append(cur_weight)
+                so_far += cur_weight
+                q_limit = self._q_limit(so_far / total)
+                cur_mean, cur_weight = mean, weight
+        out_means.append(cur_mean)
+        out_weights.append(cur_weight)
+        self.means = np.asarray(out_means)
+        self.weights = np.asarray(out_weights)
+
+    def quantile(self, q):
+        """
+        Returns the estimated q-quantile, interpolated like PERCENTILE_CONT,
+        or None for an empty digest.
+        """
+        self._flush()
+        n = self.weights.sum()
+        if not n:
+            return None
+        if len(self.means) == 1 or n == 1:
+            return float(self.means[0])
+
+        # Rank (0 based) of each centroid's centre; exact when weights are 1
+        ranks = np.cumsum(self.weights) - self.weights + (self.weights - 1) / 2
+        xs = np.concatenate([[0.0], ranks, [n - 1]])
+        ys = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q * (n - 1), xs, ys))
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+    def to_bytes(self):
+        self._flush()
+        return HEADER.pack(self.compression, self.min, self.max, len(self.means)) \
+            + self.means.astype('<f8').tobytes() + self.weights.astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        compression, minimum, maximum, size = HEADER.unpack_from(data)
+        digest = cls(compression)
+        digest.min, digest.max = minimum, maximum
+        offset = HEADER.size
+        digest.means = np.frombuffer(data, dtype='<f8', count=size, offset=offset).copy()
+        offset += 8 * size
+        digest.weights = np.frombuffer(data, dtype='<f8', count=size, offset=offset).copy()
+        return digest
+
+
+def install(using='default'):
+    """Creates the sketch tables and the trigger feeding them"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(CREATE_TABLES)
+        cursor.execute(CREATE_TRIGGER_FUNCTION)
+        cursor.execute(CREATE_TRIGGER)
+
+
+def _store(cursor, year, ship_type, digest, rebuilt=True):
+    """
+    Stores the digest of a cell. Only a digest rebuilt from fact clears the
+    stale mark; a folded one leaves a cell marked meanwhile for its rebuild.
+    """
+    cursor.execute(f'''
+        INSERT INTO eedi_sketch (year, ship_type, sketch, stale)
+        VALUES (%s, %s, %s, FALSE)
+        ON CONFLICT (year, ship_type) DO UPDATE SET sketch = EXCLUDED.sketch, stale = FALSE
+        {"" if rebuilt else "WHERE NOT eedi_sketch.stale"};
+    ''', [year, ship_type, digest.to_bytes()])
+
+
+def rebuild(using='default'):
+    """Rebuilds every sketch from the fact table"""
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('LOCK TABLE fact IN SHARE MODE;')
+            cursor.execute('DELETE FROM eedi_sketch_pending;')
+            cursor.execute('DELETE FROM eedi_sketch;')
+            cursor.execute(CELL_VALUES)
+            digests = {}
+            for year, ship_type, eedi in cursor.fetchall():
+                digests.setdefault((year, ship_type), TDigest()).add(eedi)
+            for (year, ship_type), digest in digests.items():
+                _store(cursor, year, ship_type, digest)
+
+
+def refresh(using='default'):
+    """
+    Folds queued inserts into the sketches and rebuilds stale cells.
+    Returns whether there was anything to do.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute('''
+            SELECT EXISTS (SELECT 1 FROM eedi_sketch_pending)
+                OR EXISTS (SELECT 1 FROM eedi_sketch WHERE stale);
+        ''')
+        if not cursor.fetchone()[0]:
+            return False
+
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s);', [REFRESH_LOCK])
+
+            cursor.execute('SELECT year, ship_type FROM eedi_sketch WHERE stale;')
+            for year, ship_type in cursor.fetchall():
+                # Writers marking the cell stale again wait for this rebuild
+                cursor.execute('''
+                    SELECT 1 FROM eedi_sketch WHERE year = %s AND ship_type = %s FOR UPDATE;
+                ''', [year, ship_type])
+                # One statement, so the queued rows it drops are exactly those
+                # whose facts it reads; later ones are folded next time
+                cursor.execute(f'''
+                    WITH folded AS (
+                        DELETE FROM eedi_sketch_pending WHERE year = %s AND ship_type = %s
+                    )
+                    {CELL_VALUES} AND d.year = %s AND s.ship_type = %s
+                ''', [year, ship_type, year, ship_type])
+                digest = TDigest()
+                digest.update(row[2] for row in cursor.fetchall())
+                _store(cursor, year, ship_type, digest)
+
+            cursor.execute('DELETE FROM eedi_sketch_pending RETURNING year, ship_type, eedi;')
+            pending = {}
+            for year, ship_type, eedi in cursor.fetchall():
+                pending.setdefault((year, ship_type), []).append(eedi)
+            for (year, ship_type), values in pending.items():
+                cursor.execute('''
+                    SELECT sketch, stale FROM eedi_sketch WHERE year = %s AND ship_type = %s FOR UPDATE;
+                ''', [year, ship_type])
+                row = cursor.fetchone()
+                if row and row[1]:
+                    # Marked stale since; its rebuild reads these rows from fact
+                    continue
+                digest = TDigest.from_bytes(row[0]) if row and row[0] else TDigest()
+                digest.update(values)
+                _store(cursor, year, ship_type, digest, rebuilt=False)
+    return True
+
+
+# Stored sketches, queued values of the other cells and the facts of the
+# stale cells, in one statement so they all come from the same snapshot
+LOAD = f'''
+    WITH stale AS (SELECT year, ship_type FROM eedi_sketch WHERE stale)
+    SELECT year, ship_type, sketch, NULL::DOUBLE PRECISION
+    FROM eedi_sketch WHERE NOT stale AND sketch IS NOT NULL
+    UNION ALL
+    SELECT year, ship_type, NULL, eedi
+    FROM eedi_sketch_pending
+    WHERE (year, ship_type) NOT IN (SELECT year, ship_type FROM stale)
+    UNION ALL
+    SELECT year, ship_type, NULL, eedi::DOUBLE PRECISION
+    FROM ({CELL_VALUES}) c
+    WHERE (year, ship_type) IN (SELECT year, ship_type FROM stale);
+'''
+
+
+def load(using='default'):
+    """
+    Returns a dict of (year, ship_type) to the TDigest of that cell, with the
+    changes refresh() has not stored yet merged in. Only reads, so using may
+    be a replica.
+    """
+    stored, values = {}, {}
+    with connections[using].cursor() as cursor:
+        cursor.execute(LOAD)
+        for year, ship_type, sketch, eedi in cursor.fetchall():
+            if sketch is not None:
+                stored[(year, ship_type)] = sketch
+            else:
+                values.setdefault((year, ship_type), []).append(eedi)
+
+    # Folded the way refresh() folds them, so the result does not change when it runs
+    digests = {}
+    for cell in stored.keys() | values.keys():
+        digest = TDigest.from_bytes(stored[cell]) if cell in stored else TDigest()
+        digest.update(values.get(cell, []))
+        digests[cell] = digest
+    return digests
+
+
+def rollup(cells):
+    """
+    Merges cell sketches like GROUP BY ROLLUP(year, ship_type): the result
+    maps (year, ship_type), (year, None) and (None, None) to a TDigest.
+    """
+    merged = {}
+    for (year, ship_type), digest in cells.items():
+        merged[(year, ship_type)] = digest
+        for key in [(year, None), (None, None)]:
+            if key not in merged:
+                merged[key] = TDigest(digest.compression)
+            merged[key].merge(digest)
+    return merged
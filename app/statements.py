@@ -0,0 +1,141 @@
+"""
+Server-side prepared statements for the fixed queries of the views.
+
+Each query is registered once under a name. `execute()` PREPAREs it the first
+time it is used on a database connection and runs it with EXECUTE from then
+on, so Postgres parses it once per connection and can switch to a cached
+generic plan after a few executions. Prepared statements are tracked on the
+DatabaseWrapper and forgotten whenever Django opens a new connection, so they
+only pay off on persistent connections: on an alias with CONN_MAX_AGE = 0 the
+plain SQL is run instead.
+
+Set settings.PREPARED_STATEMENTS to False to run the plain SQL instead (e.g.
+behind a transaction pooling pgbouncer, which cannot keep them).
+
+Inside `row_cap()` SELECT statements are limited to one row more than the cap
+before they are prepared, so a capped view cannot fetch a whole table
+through EXECUTE.
+"""
+import hashlib
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import ProgrammingError, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from psycopg2 import errors as pg_errors
+
+_statements = {}
+_stats = defaultdict(lambda: {'executions': 0, 'prepares': 0, 'prepare_round_trip_ms': 0.0, 'execute_ms': 0.0})
+_stats_lock = threading.Lock()
+_row_cap = threading.local()
+
+
+def register(name, sql):
+    """Registers sql, with %s placeholders, under name and returns name"""
+    if _statements.get(name, sql) != sql:
+        raise ValueError(f'Statement {name} is already registered with another query')
+    _statements[name] = sql
+    return name
+
+
+def to_positional(sql):
+    """Replaces the %s placeholders of sql with $1, $2, ..."""
+    parts = sql.split('%s')
+    return parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+
+
+def capped(sql, max_rows):
+    """Returns sql limited to max_rows + 1 rows if it is a plain SELECT"""
+    statement = sql.strip().rstrip(';')
+    if not statement[:6].upper() == 'SELECT':
+        return sql
+    return f'SELECT * FROM ({statement}) AS capped LIMIT {int(max_rows) + 1}'
+
+
+@contextmanager
+def row_cap(max_rows):
+    """Applies capped() with max_rows to the statements this thread executes in the block"""
+    previous = getattr(_row_cap, 'max_rows', None)
+    _row_cap.max_rows = max_rows
+    try:
+        yield
+    finally:
+        _row_cap.max_rows = previous
+
+
+@receiver(connection_created)
+def _forget_prepared(sender, connection, **kwargs):
+    connection.prepared_statements = set()
+
+
+def execute(cursor, name, params=()):
+    """Runs statement name on cursor with params, preparing it on this connection if needed"""
+    sql = _statements[name]
+    prepared_name = name
+    max_rows = getattr(_row_cap, 'max_rows', None)
+    if max_rows is not None and capped(sql, max_rows) != sql:
+        sql = capped(sql, max_rows)
+        # Its own statement per cap, named within the 63 characters Postgres keeps
+        prepared_name = f'capped_{hashlib.md5(sql.encode()).hexdigest()}'
+    connection = cursor.db
+    # A connection closed after the request would PREPARE on every execution
+    if not getattr(settings, 'PREPARED_STATEMENTS', True) or not connection.settings_dict.get('CONN_MAX_AGE'):
+        cursor.execute(sql, params)
+        return cursor
+
+    prepared = connection.__dict__.setdefault('prepared_statements', set())
+    args = f'({", ".join(["%s"] * len(params))})' if params else ''
+    for attempt in range(2):
+        if prepared_name not in prepared:
+            started = time.perf_counter()
+            cursor.execute(f'PREPARE {prepared_name} AS {to_positional(sql)}')
+            prepared.add(prepared_name)
+            with _stats_lock:
+                _stats[name]['prepares'] += 1
+                _stats[name]['prepare_round_trip_ms'] += (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        try:
+            cursor.execute(f'EXECUTE {prepared_name}{args}', params)
+        except ProgrammingError as e:
+            # Deallocated behind our back (e.g. DISCARD ALL); prepare it again
+            # unless that happened inside a transaction, which is now aborted
+            missing = isinstance(e.__cause__, pg_errors.InvalidSqlStatementName)
+            if not missing or attempt or connection.in_atomic_block:
+                raise
+            prepared.discard(prepared_name)
+            continue
+        with _stats_lock:
+            _stats[name]['executions'] += 1
+            _stats[name]['execute_ms'] += (time.perf_counter() - started) * 1000
+        return cursor
+
+
+def stats():
+    """
+    Returns the statements' counters in this process. The times are
+    client-side round trips; server_stats() tells how Postgres planned them.
+    """
+    with _stats_lock:
+        return {name: dict(counters) for name, counters in _stats.items()}
+
+
+def server_stats(using='default'):
+    """
+    Returns how many generic (cached) and custom plans each statement
+    prepared on this thread's connection used, as Postgres counts them. The
+    counts are None before Postgres 14, which does not keep them.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.pg_version < 140000:
+            cursor.execute('SELECT name, NULL, NULL FROM pg_prepared_statements;')
+        else:
+            cursor.execute('SELECT name, generic_plans, custom_plans FROM pg_prepared_statements;')
+        return {
+            name: {'generic_plans': generic, 'custom_plans': custom}
+            for name, generic, custom in cursor.fetchall()
+        }
@@ -0,0 +1,150 @@
+// Applies the deltas streamed by /live/ (see app/live.py) to the charts and
+// tables of the current page, instead of reloading it.
+(function () {
+  'use strict';
+
+  if (!window.EventSource) {
+    return;
+  }
+
+  // Versions of the tables the page was built from (app/live.py)
+  var script = document.currentScript;
+  var since = (script && script.getAttribute('data-live-since')) || '';
+
+  var TYPED_ARRAYS = {
+    f8: Float64Array, f4: Float32Array,
+    i4: Int32Array, i2: Int16Array, i1: Int8Array,
+    u4: Uint32Array, u2: Uint16Array, u1: Uint8Array
+  };
+
+  // Traces sent as {dtype, bdata} (app/figures.py) are decoded before they
+  // are extended, whatever plotly.js kept in gd.data
+  function decode(values) {
+    if (!values || !values.bdata) {
+      return values;
+    }
+    var binary = atob(values.bdata);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+      bytes[i] = binary.charCodeAt(i);
+    }
+    return new TYPED_ARRAYS[values.dtype](bytes.buffer);
+  }
+
+  function chart(id) {
+    var div = document.getElementById(id);
+    return div && window.Plotly && div.data ? div : null;
+  }
+
+  function on(source, name, apply) {
+    source.addEventListener(name, function (event) {
+      if (event.lastEventId) {
+        since = event.lastEventId;
+      }
+      apply(JSON.parse(event.data));
+    });
+  }
+
+  // A page that is still behind after reloading must not reload forever
+  var RESYNC_MS = 60000;
+
+  function mayResync() {
+    try {
+      var last = Number(sessionStorage.getItem('live-resync'));
+      if (last && Date.now() - last < RESYNC_MS) {
+        return false;
+      }
+      sessionStorage.setItem('live-resync', String(Date.now()));
+    } catch (e) {
+      return false;
+    }
+    return true;
+  }
+
+  // A worker with no stream left answers 503, after which EventSource gives up
+  var RETRY_MS = 30000;
+
+  function connect() {
+    var source = new EventSource('/live/?since=' + encodeURIComponent(since));
+    source.onerror = function () {
+      if (source.readyState === EventSource.CLOSED) {
+        setTimeout(connect, RETRY_MS);
+      }
+    };
+
+    on(source, 'extend', function (delta) {
+      var div = chart(delta.div);
+      if (!div) {
+        return;
+      }
+      delta.traces.forEach(function (index) {
+        div.data[index].x = decode(div.data[index].x);
+        div.data[index].y = decode(div.data[index].y);
+      });
+      Plotly.extendTraces(div, {x: delta.x, y: delta.y}, delta.traces);
+    });
+
+    on(source, 'fit', function (delta) {
+      var div = chart(delta.div);
+      if (!div) {
+        return;
+      }
+      var x = decode(div.data[0].x);
+      var low = Infinity;
+      var high = -Infinity;
+      for (var i = 0; i < x.length; i++) {
+        low = Math.min(low, x[i]);
+        high = Math.max(high, x[i]);
+      }
+      if (low > high) {
+        return;
+      }
+      Plotly.restyle(div, {
+        x: [[low, high]],
+        y: [[delta.intercept + delta.slope * low, delta.intercept + delta.slope * high]]
+      }, [delta.trace]);
+    });
+
+    on(source, 'restyle', function (delta) {
+      var div = chart(delta.div);
+      if (div) {
+        Plotly.restyle(div, delta.update, delta.traces);
+      }
+    });
+
+    on(source, 'reload', function (delta) {
+      if (document.getElementById(delta.div) && (!delta.resync || mayResync())) {
+        source.close();
+        window.location.reload();
+      }
+    });
+
+    on(source, 'count', function (delta) {
+      var elements = document.querySelectorAll('[data-live-count="' + delta.table + '"]');
+      for (var i = 0; i < elements.length; i++) {
+        elements[i].textContent = delta.count;
+      }
+    });
+
+    on(source, 'rows', function (delta) {
+      var body = document.querySelector('[data-live-rows="' + delta.table + '"]');
+      // Only the page the rows were read for is replaced
+      if (!body || body.getAttribute('data-live-page') !== String(delta.page)) {
+        return;
+      }
+      var rows = delta.rows.map(function (row) {
+        var tr = document.createElement('tr');
+        row.forEach(function (value) {
+          var td = document.createElement('td');
+          // As app/tables.py renders them, with the template's default:'0'
+          td.textContent = value || '0';
+          tr.appendChild(td);
+        });
+        return tr;
+      });
+      body.replaceChildren.apply(body, rows);
+    });
+  }
+
+  connect();
+})();
@@ -0,0 +1,134 @@
+"""
+Cached HTML fragments of the table pages.
+
+The list templates used to render every cell through `{% for val in row %}`
+and the `default` filter (see benchmarks/bench_tables.py). Here the rows
+are rendered by `render_rows()` in plain Python, with the same output as
+that loop, and each rendered page is cached under a key
+made of its statement (table and order_by), page number, the active
+language (whose formats the cells use) and the versions of the tables it
+reads (app.invalidation), so a change to a table makes every worker miss
+its pages. Entries also expire after TABLE_FRAGMENT_TTL seconds,
+which bounds how stale a page read from a lagging replica can get.
+"""
+import html
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.template import Context
+from django.template.base import render_value_in_context
+from django.utils import dateformat, numberformat, timezone
+from django.utils.formats import get_format
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
+from app import statements
+from app.invalidation import versioned_key
+from app.utils import clamp
+
+Page = namedtuple('Page', ['page', 'num_pages', 'count', 'rows'])
+
+# Autoescaping context with the project's USE_TZ and USE_L10N, as in render()
+_CONTEXT = Context(autoescape=True)
+
+
+def _cell_formatters():
+    """
+    Returns a formatter per common column type that renders a value as
+    render_value_in_context() does, with the active language's formats and
+    time zone looked up once instead of for every cell.
+    """
+    number = partial(
+        numberformat.format,
+        decimal_sep=get_format('DECIMAL_SEPARATOR'),
+        grouping=get_format('NUMBER_GROUPING'),
+        thousand_sep=get_format('THOUSAND_SEPARATOR'),
+        use_l10n=settings.USE_L10N,
+    )
+    date_format = get_format('DATE_FORMAT')
+    datetime_format = get_format('DATETIME_FORMAT')
+    zone = timezone.get_current_timezone() if settings.USE_TZ else None
+    dates = {}
+
+    def format_date(value):
+        # Pages repeat the same few dates, and dateformat is slow
+        if value not in dates:
+            dates[value] = html.escape(dateformat.format(value, date_format))
+        return dates[value]
+
+    def format_datetime(value):
+        if zone is not None and not timezone.is_naive(value):
+            value = value.astimezone(zone)
+        return html.escape(dateformat.format(value, datetime_format))
+
+    return {
+        str: html.escape,
+        int: lambda value: html.escape(number(value)),
+        float: lambda value: html.escape(number(value)),
+        Decimal: lambda value: html.escape(number(value)),
+        date: format_date,
+        datetime: format_datetime,
+    }
+
+
+def render_rows(rows, link=None):
+    """
+    Returns the <tr> elements of rows, each value rendered as
+    `{{ value|default:'0' }}` does. link, a format string taking the first
+    value of the row, makes each row open that URL when clicked.
+    """
+    formatters = _cell_formatters()
+
+    def cell(value):
+        if not value:
+            return '0'
+        format_value = formatters.get(type(value))
+        if format_value is None:
+            return render_value_in_context(value, _CONTEXT)
+        return format_value(value)
+
+    parts = []
+    for row in rows:
+        if link:
+            url = html.escape(link.format(row[0]))
+            parts.append(f'<tr style="cursor:pointer;" onclick="window.location=\'{url}\'">')
+        else:
+            parts.append('<tr>')
+        parts += [f'<td>{cell(value)}</td>' for value in row]
+        parts.append('</tr>\n')
+    return mark_safe(''.join(parts))
+
+
+def _ttl():
+    return getattr(settings, 'TABLE_FRAGMENT_TTL', 10 * 60)
+
+
+def page(page_statement, count_statement, page, page_size, tables, link=None, using='default'):
+    """
+    Returns the Page of the rows page_statement returns for page, clamped to
+    the pages count_statement allows, with its rows rendered by render_rows().
+    tables are the tables both statements read.
+    """
+    count_key = versioned_key(f'table-count:{count_statement}', *tables)
+    count = cache.get(count_key)
+    if count is None:
+        with connections[using].cursor() as cursor:
+            statements.execute(cursor, count_statement)
+            count = cursor.fetchone()[0]
+        cache.set(count_key, count, timeout=_ttl())
+    num_pages = (count - 1) // page_size + 1
+    page = clamp(page, 1, num_pages)
+
+    key = versioned_key(f'table-page:{page_statement}:{get_language()}:{page_size}:{page}', *tables)
+    html = cache.get(key)
+    if html is None:
+        with connections[using].cursor() as cursor:
+            statements.execute(cursor, page_statement, [(page - 1) * page_size, page_size])
+            html = str(render_rows(cursor.fetchall(), link))
+        cache.set(key, html, timeout=_ttl())
+    return Page(page, num_pages, count, mark_safe(html))
@@ -1,6 +1,33 @@
 from django.contrib.auth.models import AnonymousUser, User
-from django.test import TestCase, RequestFactory
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import timezone, translation
+from django.db import IntegrityError, connection, transaction
+from django.template import Template, Context
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 
+import numpy as np
+import psycopg2
+
+import base64
+import json
+from datetime import date, timedelta
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+from .cube import DIMENSIONS, drill_down, roll_up
+from . import (
+    admission, cube, dashboards, greetings, invalidation, live, profiling, records, regression, sketches, statements,
+    tables, topk,
+)
+from .figures import bar, encode_array, expand_layout, figure_div
+from .regression import fit_from_sums
+from .routers import PIN_COOKIE, PrimaryPinningMiddleware, read_db, write_db
+from .sketches import TDigest, rollup
+from . import views
 from .views import index
 
 
@@ -17,3 +44,626 @@ class SimpleTest(TestCase):
         # Test my_view() as if it were deployed at /customer/details
         response = index(request)
         self.assertEqual(response.status_code, 200)
+
+
+class RegressionStatsTest(SimpleTestCase):
+    def test_fit_from_sums_matches_polyfit(self):
+        x = np.log10([120.0, 300.0, 450.0, 800.0, 1500.0])
+        y = np.log10([2000.0, 4100.0, 7300.0, 9800.0, 22000.0])
+        fit = fit_from_sums(len(x), x.sum(), y.sum(), (x * x).sum(), (x * y).sum(), (y * y).sum())
+
+        slope, intercept = np.polyfit(x, y, 1)
+        self.assertAlmostEqual(fit.slope, slope)
+        self.assertAlmostEqual(fit.intercept, intercept)
+        self.assertAlmostEqual(fit.r2, np.corrcoef(x, y)[0, 1] ** 2)
+        self.assertAlmostEqual(fit.predict([x[0]])[0], intercept + slope * x[0])
+
+    def test_fit_from_sums_needs_two_distinct_points(self):
+        self.assertIsNone(fit_from_sums(1, 2.0, 3.0, 4.0, 6.0, 9.0))
+        self.assertIsNone(fit_from_sums(2, 4.0, 6.0, 8.0, 12.0, 18.0))
+
+
+class EediSketchTest(SimpleTestCase):
+    def test_small_digest_matches_percentile_cont(self):
+        values = [3.1, 7.4, 2.2, 9.9, 5.0, 4.4, 8.1]
+        digest = TDigest()
+        digest.update(values)
+        for q in [0.0, 0.25, 0.5, 0.95, 1.0]:
+            self.assertAlmostEqual(digest.quantile(q), np.percentile(values, q * 100))
+
+    def test_rank_error_and_round_trip(self):
+        values = np.random.default_rng(5110).lognormal(2, 0.5, 20000)
+        digest = TDigest(TDigest().compression)
+        digest.update(values)
+        restored = TDigest.from_bytes(digest.to_bytes())
+        for q in [0.05, 0.25, 0.5, 0.75, 0.95]:
+            estimate = restored.quantile(q)
+            self.assertEqual(estimate, digest.quantile(q))
+            self.assertLess(abs((values < estimate).mean() - q), 0.01)
+
+    def test_rollup_merges_cells(self):
+        first, second = TDigest(), TDigest()
+        first.update(range(100))
+        second.update(range(100, 200))
+        merged = rollup({(2020, 'Tanker'): first, (2021, 'Tanker'): second})
+        self.assertEqual(merged[(None, None)].count, 200)
+        self.assertEqual(merged[(2021, None)].quantile(0.5), 149.5)
+        self.assertEqual(merged[(None, None)].quantile(0.5), 99.5)
+
+
+class CubeHierarchyTest(SimpleTestCase):
+    def test_drill_down_adds_next_date_level(self):
+        self.assertEqual(drill_down(['ship_type']), ['ship_type', 'year'])
+        self.assertEqual(drill_down(['year', 'ship_type']), ['year', 'ship_type', 'year_half'])
+        self.assertIsNone(drill_down(['week']))
+
+    def test_roll_up_removes_finest_date_level(self):
+        self.assertEqual(roll_up(['quarter', 'year', 'verifier_country']), ['year', 'verifier_country'])
+        self.assertIsNone(roll_up(['ship_type']))
+
+
+# The warehouse tables are unmanaged, so the tests create them in their transaction
+WAREHOUSE = '''
+    CREATE TABLE ship_dim (ship_id INTEGER PRIMARY KEY, imo BIGINT, ship_name VARCHAR(64), ship_type VARCHAR(64));
+    CREATE TABLE verifier_dim (verifier_id INTEGER PRIMARY KEY, verifier_country TEXT);
+    CREATE TABLE date_dim (
+        date_id INTEGER PRIMARY KEY, date DATE, week INTEGER, month INTEGER,
+        quarter INTEGER, year_half INTEGER, year INTEGER
+    );
+    CREATE TABLE fact (
+        ship_id INTEGER, verifier_id INTEGER, date_id INTEGER, eedi NUMERIC,
+        total_fuel_consmp NUMERIC, total_co2 NUMERIC, total_time_sea NUMERIC,
+        PRIMARY KEY (ship_id, verifier_id, date_id)
+    );
+    INSERT INTO ship_dim VALUES (1, 9100001, 'Aurora', 'Bulk carrier'), (2, 9100002, 'Borealis', 'Bulk carrier'),
+                                (3, 9100003, 'Cygnus', 'Oil tanker');
+    INSERT INTO verifier_dim VALUES (1, 'NO'), (2, NULL);
+    INSERT INTO date_dim VALUES (1, '2020-01-15', 3, 1, 1, 1, 2020), (2, '2020-08-15', 33, 8, 3, 2, 2020),
+                                (3, '2021-01-15', 2, 1, 1, 1, 2021);
+'''
+
+
+class WarehouseTestCase(TestCase):
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(WAREHOUSE)
+
+    def execute(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+class RegressionTriggerTest(WarehouseTestCase):
+    def cells(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                SELECT ship_type, year, {", ".join(regression.SUM_COLUMNS)}
+                FROM fact_regression_stats WHERE n <> 0 ORDER BY ship_type, year
+            ''')
+            return cursor.fetchall()
+
+    def assertMatchesRebuild(self):
+        maintained = self.cells()
+        regression.rebuild()
+        rebuilt = self.cells()
+        self.assertEqual([row[:3] for row in maintained], [row[:3] for row in rebuilt])
+        for row, expected in zip(maintained, rebuilt):
+            for value, expected_value in zip(row[3:], expected[3:]):
+                self.assertAlmostEqual(value, expected_value, places=6)
+
+    def test_trigger_matches_rebuild(self):
+        regression.install()
+        self.execute('''
+            INSERT INTO fact VALUES (1, 1, 1, 5, 10, 30, 100), (2, 1, 1, NULL, 20, 60, 200),
+                                    (3, 2, 2, 7, 30, 90, 300), (1, 2, 3, 9, 40, 120, 400),
+                                    (2, 2, 2, 6, NULL, 150, 500), (3, 1, 3, 4, 50, 0, 600);
+        ''')
+        self.assertMatchesRebuild()
+
+        self.execute('UPDATE fact SET date_id = 3, total_co2 = 10 WHERE ship_id = 2 AND date_id = 1;')
+        self.execute('UPDATE fact SET total_fuel_consmp = 25 WHERE ship_id = 2 AND date_id = 2;')
+        self.execute('DELETE FROM fact WHERE ship_id = 1 AND date_id = 1;')
+        self.assertMatchesRebuild()
+        self.assertEqual(regression.get_fits(year=2021)['co2'].n, 2)
+
+
+class CubeTriggerTest(WarehouseTestCase):
+    def assertMatchesRebuild(self, by):
+        maintained = cube.query(by)
+        cube.rebuild()
+        rebuilt = cube.query(by)
+        self.assertEqual(len(maintained), len(rebuilt))
+        for row, expected in zip(maintained, rebuilt):
+            for name, value in row._asdict().items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, getattr(expected, name), places=6)
+                else:
+                    self.assertEqual(value, getattr(expected, name))
+
+    def test_trigger_matches_rebuild(self):
+        cube.install()
+        self.execute('''
+            INSERT INTO fact VALUES (1, 1, 1, 5, 10, 30, 100), (2, 1, 1, NULL, 20, 60, 200),
+                                    (3, 2, 2, 7, 30, 90, 300), (1, 2, 3, 9, 40, 120, 400);
+        ''')
+        self.execute('INSERT INTO fact VALUES (2, 2, 2, 6, 50, 150, 500);')
+        self.assertMatchesRebuild(DIMENSIONS)
+
+        self.execute('UPDATE fact SET date_id = 3, total_co2 = 10 WHERE ship_id = 2 AND date_id = 1;')
+        self.execute('DELETE FROM fact WHERE ship_id = 1 AND date_id = 1;')
+        self.assertMatchesRebuild(DIMENSIONS)
+        self.assertMatchesRebuild(['year', 'ship_type'])
+        self.assertEqual(cube.query([])[0].n, 4)
+
+
+class TopKTriggerTest(WarehouseTestCase):
+    def rankings(self):
+        return {
+            (metric, direction, year): topk.lookup(metric, direction, year=year)
+            for metric in topk.METRICS for direction in topk.DIRECTIONS for year in [topk.ALL_YEARS, 2020, 2021]
+        }
+
+    def assertMatchesRebuild(self):
+        maintained = self.rankings()
+        topk.rebuild()
+        self.assertEqual(maintained, self.rankings())
+
+    def test_trigger_matches_rebuild(self):
+        topk.install()
+        self.execute('''
+            INSERT INTO fact VALUES (1, 1, 1, 5, 10, 30, 100), (2, 1, 1, NULL, 20, 60, 900),
+                                    (3, 2, 2, 7, 30, 90, 300), (1, 2, 3, 9, 40, 120, 400);
+        ''')
+        self.assertMatchesRebuild()
+        self.assertEqual(topk.lookup('time_sea', 'highest')[0].ship_name, 'Borealis')
+
+        self.execute('UPDATE fact SET date_id = 3, eedi = 2 WHERE ship_id = 2;')
+        self.assertMatchesRebuild()
+        self.execute('DELETE FROM fact WHERE ship_id = 1 AND date_id = 1;')
+        self.assertMatchesRebuild()
+
+
+class SketchRefreshTest(WarehouseTestCase):
+    def percentiles(self):
+        return {cell: digest.quantiles([0.1, 0.5, 0.9]) for cell, digest in sketches.load().items()}
+
+    def test_refresh_matches_rebuild(self):
+        sketches.install()
+        self.execute('INSERT INTO fact VALUES (1, 1, 1, 5, 10, 30, 100), (2, 1, 1, 8, 20, 60, 200);')
+        sketches.rebuild()
+        # Queued inserts, and a stale cell that also has queued inserts
+        self.execute('INSERT INTO fact VALUES (3, 2, 2, 7, 30, 90, 300), (3, 1, 1, 2, 40, 120, 400);')
+        self.execute('UPDATE fact SET eedi = 11 WHERE ship_id = 1;')
+        self.execute('INSERT INTO fact VALUES (2, 2, 1, 9, 50, 150, 500);')
+        with self.assertNumQueries(1):
+            loaded = self.percentiles()
+        self.assertTrue(sketches.refresh())
+        refreshed = self.percentiles()
+        self.assertEqual(loaded, refreshed)
+
+        sketches.rebuild()
+        self.assertEqual(refreshed, self.percentiles())
+        self.assertEqual([round(q, 6) for q in refreshed[(2020, 'Bulk carrier')]], [8.2, 9.0, 10.6])
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class PrimaryPinningTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def route(self, request, write=False):
+        seen = {}
+
+        def view(request):
+            if write:
+                write_db()
+            seen['read'] = read_db()
+            return HttpResponse()
+
+        response = PrimaryPinningMiddleware(view)(request)
+        return seen['read'], response
+
+    def test_reads_go_to_replica(self):
+        alias, response = self.route(self.factory.get('/emissions/'))
+        self.assertEqual(alias, 'replica')
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_write_pins_request_and_following_reads(self):
+        alias, response = self.route(self.factory.post('/emissions/imo/'), write=True)
+        self.assertEqual(alias, 'default')
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        request = self.factory.get('/emissions/imo/1234567?inserted=true')
+        request.COOKIES[PIN_COOKIE] = '1'
+        alias, response = self.route(request)
+        self.assertEqual(alias, 'default')
+
+
+class InvalidationVersionTest(SimpleTestCase):
+    def test_evicted_version_does_not_restart_at_an_old_value(self):
+        seen = {invalidation.version('date_dim')}
+        invalidation.changed('date_dim')
+        seen.add(invalidation.version('date_dim'))
+        cache.delete(invalidation._version_key('date_dim'))
+        self.assertNotIn(invalidation.version('date_dim'), seen)
+
+        cache.delete(invalidation._version_key('date_dim'))
+        invalidation.changed('date_dim')
+        self.assertNotIn(invalidation.version('date_dim'), seen)
+
+
+class ChangeNotificationTest(TestCase):
+    def setUp(self):
+        # Notifications are only sent on commit, so write on a connection of its own
+        self.other = psycopg2.connect(**connection.get_connection_params())
+        self.addCleanup(self.other.close)
+        self.other.autocommit = True
+        self.cursor = self.other.cursor()
+        self.cursor.execute('CREATE TEMPORARY TABLE co2emission_reduced (imo BIGINT, ship_name TEXT);')
+        self.cursor.execute(invalidation.CREATE_NOTIFY_FUNCTION)
+        self.cursor.execute(invalidation.CREATE_TRIGGER.format(table='co2emission_reduced', args="'imo'"))
+        self.cursor.execute(f'LISTEN {invalidation.CHANNEL};')
+
+    def notifications(self):
+        self.other.poll()
+        payloads = [json.loads(notify.payload) for notify in self.other.notifies]
+        self.other.notifies.clear()
+        return payloads
+
+    def test_one_notification_per_statement(self):
+        self.cursor.execute("INSERT INTO co2emission_reduced VALUES (9100001, 'Aurora'), (9100002, 'Borealis');")
+        self.assertEqual(self.notifications(), [
+            {'table': 'co2emission_reduced', 'op': 'INSERT', 'keys': [{'imo': 9100001}, {'imo': 9100002}]},
+        ])
+
+        self.cursor.execute("UPDATE co2emission_reduced SET imo = 9100003 WHERE imo = 9100002;")
+        self.assertEqual(self.notifications(), [
+            {'table': 'co2emission_reduced', 'op': 'UPDATE', 'keys': [{'imo': 9100002}, {'imo': 9100003}]},
+        ])
+
+        self.cursor.execute("UPDATE co2emission_reduced SET ship_name = 'Cygnus' WHERE imo = 0;")
+        self.assertEqual(self.notifications(), [])
+
+        self.cursor.execute(
+            'INSERT INTO co2emission_reduced SELECT 9200000 + i FROM generate_series(1, %s) i;',
+            [invalidation.MAX_NOTIFY_KEYS + 1],
+        )
+        self.assertEqual(self.notifications(), [{'table': 'co2emission_reduced', 'op': 'INSERT', 'keys': None}])
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], DASHBOARD_MAX_AGE=60)
+class DashboardTest(SimpleTestCase):
+    def setUp(self):
+        self.builds = []
+        dashboards.register('test', self.build, tables=['fact'])
+        cache.delete(dashboards._cache_key('test'))
+        self.addCleanup(cache.delete, dashboards._cache_key('test'))
+
+    def build(self):
+        time.sleep(0.05)
+        self.builds.append(read_db())
+        return {'build': len(self.builds)}
+
+    def test_cold_dashboard_is_built_once_for_concurrent_requests(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(dashboards.get('test'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [{'build': 1}] * 5)
+        # Rebuilds read the primary whatever the request would
+        self.assertEqual(self.builds, ['default'])
+
+    @override_settings(DASHBOARD_COLD_WAIT=0.2)
+    def test_cold_request_builds_itself_when_the_rebuild_is_slow(self):
+        # Held by a rebuild that never finishes
+        cache.add(dashboards._lock_key('test'), True)
+        self.addCleanup(cache.delete, dashboards._lock_key('test'))
+        started = time.monotonic()
+        self.assertEqual(dashboards.get('test'), {'build': 1})
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_warm_builds_missing_dashboards_before_returning(self):
+        self.assertEqual(dashboards.warm(['test'], stale_in_background=True), ['test'])
+        self.assertEqual(self.builds, ['default'])
+        self.assertEqual(dashboards.warm(['test'], stale_in_background=True), [])
+
+    def test_fresh_dashboard_is_served_from_cache(self):
+        dashboards.get('test')
+        self.assertEqual(dashboards.get('test'), {'build': 1})
+        # No background rebuild was queued
+        self.assertIsNone(cache.get(dashboards._lock_key('test')))
+        self.assertEqual(len(self.builds), 1)
+
+    def test_stale_dashboard_is_served_while_rebuilt(self):
+        dashboards.get('test')
+        invalidation.changed('fact')
+        self.assertEqual(dashboards.get('test'), {'build': 1})
+        self.assertIsNone(dashboards.schedule_rebuild('test'))
+        while cache.get(dashboards._lock_key('test')):
+            time.sleep(0.01)
+        self.assertEqual(dashboards.get('test'), {'build': 2})
+
+
+class FigureEncodingTest(SimpleTestCase):
+    def test_numeric_arrays_are_base64_typed_arrays(self):
+        encoded = encode_array([Decimal('1.5'), Decimal('2.25')])
+        self.assertEqual(encoded['dtype'], 'f8')
+        decoded = np.frombuffer(base64.b64decode(encoded['bdata']), dtype='<f8')
+        self.assertEqual(decoded.tolist(), [1.5, 2.25])
+
+    def test_category_arrays_stay_lists(self):
+        trace = bar(x=['Bulk carrier', 'Oil tanker'], y=[1, 2], name='avg')
+        self.assertEqual(trace['x'], ['Bulk carrier', 'Oil tanker'])
+        self.assertEqual(trace['type'], 'bar')
+
+    def test_layout_underscore_keys_are_expanded(self):
+        layout = expand_layout({'title': 'EEDI', 'xaxis_title': 'year', 'height': 620})
+        self.assertEqual(layout, {
+            'title': {'text': 'EEDI'},
+            'xaxis': {'title': {'text': 'year'}},
+            'height': 620,
+        })
+
+    def test_div_escapes_script_content(self):
+        html = figure_div(bar(x=['</script><b>'], y=[1]), {'height': 620}, div_id='chart')
+        self.assertIn('id="chart"', html)
+        self.assertEqual(html.count('</script>'), 1)
+
+
+class ProfilingMiddlewareTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def view(self, request):
+        time.sleep(0.05)
+        return HttpResponse()
+
+    def test_signed_token_stores_capture(self):
+        with override_settings(PROFILE_DIR=self.dir.name, PROFILE_INTERVAL_MS=1):
+            request = self.factory.get('/visual/', {'profile': profiling.make_token()})
+            response = profiling.ProfilingMiddleware(self.view)(request)
+            [capture] = profiling.list_captures()
+            document = profiling.load(capture['id'])
+
+        self.assertEqual(response[profiling.RESPONSE_HEADER], capture['id'])
+        self.assertEqual(capture['path'], '/visual/')
+        self.assertGreater(capture['samples'], 0)
+        self.assertIn('view (tests.py)', profiling.to_folded(document))
+
+    def test_bad_token_is_ignored(self):
+        with override_settings(PROFILE_DIR=self.dir.name, PROFILE_SAMPLE_RATE=0):
+            request = self.factory.get('/visual/', {'profile': 'forged'})
+            response = profiling.ProfilingMiddleware(self.view)(request)
+            self.assertNotIn(profiling.RESPONSE_HEADER, response)
+            self.assertEqual(profiling.list_captures(), [])
+
+
+class AdmissionControlTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def view(self, request):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT generate_series(1, 50);')
+        return HttpResponse()
+
+    def test_full_queue_is_rejected_with_retry_after(self):
+        limited = admission.limit(self.view, concurrency=1, queue=0, name='full')
+        other = psycopg2.connect(**connection.get_connection_params())
+        self.addCleanup(other.close)
+        cursor = other.cursor()
+        cursor.execute('SELECT pg_advisory_lock(%s, 0);', [admission._lock_key('full')])
+
+        response = limited(self.factory.get('/adv_q_visual/'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+
+        cursor.execute('SELECT pg_advisory_unlock(%s, 0);', [admission._lock_key('full')])
+        self.assertEqual(limited(self.factory.get('/adv_q_visual/')).status_code, 200)
+
+    def test_row_cap(self):
+        capped = admission.limit(self.view, max_rows=10, name='capped')
+        self.assertEqual(capped(self.factory.get('/cube/')).status_code, 503)
+
+    def test_row_cap_is_applied_by_the_server(self):
+        self.assertEqual(
+            statements.capped('SELECT generate_series(1, 50);', 10),
+            'SELECT * FROM (SELECT generate_series(1, 50)) AS capped LIMIT 11',
+        )
+        self.assertEqual(statements.capped('DELETE FROM greeting;', 10), 'DELETE FROM greeting;')
+
+    def test_row_cap_applies_to_prepared_statements(self):
+        statements.register('test_series', 'SELECT generate_series(1, 50)')
+
+        def view(request):
+            with connection.cursor() as cursor:
+                statements.execute(cursor, 'test_series')
+                return HttpResponse(len(cursor.fetchall()))
+
+        capped = admission.limit(view, max_rows=10, name='capped_prepared')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(capped(self.factory.get('/cube/')).status_code, 503)
+        [prepare] = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('PREPARE')]
+        self.assertTrue(prepare.endswith('LIMIT 11'))
+        self.assertEqual(view(self.factory.get('/cube/')).content, b'50')
+
+    def test_timeout_outlives_a_rolled_back_savepoint(self):
+        def view(request):
+            with connection.cursor() as cursor:
+                try:
+                    with transaction.atomic():
+                        cursor.execute('SELECT 1;')
+                        raise IntegrityError
+                except IntegrityError:
+                    pass
+                cursor.execute('SHOW statement_timeout;')
+                return HttpResponse(cursor.fetchone()[0])
+
+        timed = admission.limit(view, statement_timeout=1234, name='timed')
+        self.assertEqual(timed(self.factory.get('/cube/')).content, b'1234ms')
+
+
+class PreparedStatementTest(SimpleTestCase):
+    def test_placeholders_become_positional(self):
+        sql = statements.to_positional('SELECT * FROM fact ORDER BY eedi OFFSET %s LIMIT %s')
+        self.assertEqual(sql, 'SELECT * FROM fact ORDER BY eedi OFFSET $1 LIMIT $2')
+
+    def test_name_cannot_be_reused_for_another_query(self):
+        statements.register('test_statement', 'SELECT 1')
+        statements.register('test_statement', 'SELECT 1')
+        with self.assertRaises(ValueError):
+            statements.register('test_statement', 'SELECT 2')
+
+
+class PreparedStatementExecutionTest(TestCase):
+    def setUp(self):
+        statements.register('test_one', 'SELECT 1')
+
+    def test_statement_is_prepared_once_per_connection(self):
+        with CaptureQueriesContext(connection) as queries, connection.cursor() as cursor:
+            for _ in range(3):
+                statements.execute(cursor, 'test_one')
+        self.assertEqual(sum(query['sql'].startswith('PREPARE') for query in queries.captured_queries), 1)
+        if connection.pg_version >= 140000:
+            self.assertGreater(sum(statements.server_stats()['test_one'].values()), 0)
+
+    def test_non_persistent_connections_run_plain_sql(self):
+        self.addCleanup(connection.settings_dict.__setitem__, 'CONN_MAX_AGE', connection.settings_dict['CONN_MAX_AGE'])
+        connection.settings_dict['CONN_MAX_AGE'] = 0
+        with CaptureQueriesContext(connection) as queries, connection.cursor() as cursor:
+            statements.execute(cursor, 'test_one')
+        self.assertEqual([query['sql'] for query in queries.captured_queries], ['SELECT 1'])
+
+
+class RecordCacheTest(TestCase):
+    def test_write_fills_the_cache_until_a_notification(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            records.written(9100001, {'imo': 9100001, 'ship_name': 'Aurora'}, 'UPDATE')
+        with self.assertNumQueries(0):
+            self.assertEqual(records.get(9100001)['ship_name'], 'Aurora')
+
+        # Any notification evicts it, including the one of that write
+        invalidation.changed('co2emission_reduced', [{'imo': 9100001}], 'UPDATE')
+        self.assertIsNone(cache.get(records._key(9100001)))
+
+    def test_deleted_imo_is_negatively_cached(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            records.written(9100002, None, 'DELETE')
+        self.assertIsNone(records.get(9100002))
+        self.assertGreater(records.stats()['negative_hits'], 0)
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_misses_are_read_from_the_primary(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE co2emission_reduced (imo BIGINT PRIMARY KEY, ship_name VARCHAR(64));')
+            cursor.execute("INSERT INTO co2emission_reduced VALUES (9100003, 'Cygnus');")
+        # There is no 'replica' database, so reading it would fail
+        self.assertEqual(records.get(9100003)['ship_name'], 'Cygnus')
+
+
+@override_settings(GREETING_FLUSH_SECONDS=3600, GREETING_PAGE_SIZE=3)
+class GreetingBufferTest(TestCase):
+    def test_buffered_greetings_are_read_back_and_flushed(self):
+        now = timezone.now()
+        for minutes in range(5):
+            greetings.add(now - timedelta(minutes=minutes))
+        self.assertEqual([row['when'] for row in greetings.recent()], [
+            now, now - timedelta(minutes=1), now - timedelta(minutes=2),
+        ])
+
+        self.assertEqual(greetings.flush(), 5)
+        self.assertEqual(greetings.pending(), [])
+        older = greetings.recent(before=now - timedelta(minutes=2))
+        self.assertEqual([row['when'] for row in older], [
+            now - timedelta(minutes=3), now - timedelta(minutes=4),
+        ])
+
+    def test_trim_keeps_recent_rows(self):
+        greetings.add(timezone.now() - timedelta(days=30))
+        greetings.add(timezone.now())
+        greetings.flush()
+        self.assertEqual(greetings.trim(days=7, batch_size=1), 1)
+        self.assertEqual(len(greetings.recent()), 1)
+
+
+@override_settings(LIVE_HEARTBEAT_SECONDS=0.01, LIVE_STREAM_SECONDS=60)
+class LiveStreamTest(SimpleTestCase):
+    def test_published_deltas_reach_open_streams(self):
+        events = live.stream()
+        self.assertEqual(next(events), 'retry: 5000\n\n')
+        self.assertEqual(next(events), ': keep-alive\n\n')
+
+        live.publish([live.format_event('count', {'table': 'fact', 'count': 3})])
+        self.assertEqual(next(events), 'event: count\ndata: {"table":"fact","count":3}\n\n')
+        events.close()
+        self.assertEqual(live._clients, set())
+
+    @override_settings(LIVE_MAX_STREAMS=1)
+    def test_streams_beyond_the_cap_are_refused(self):
+        events = live.stream()
+        self.addCleanup(events.close)
+        self.assertIsNone(live.stream())
+        self.assertEqual(views.live_updates(RequestFactory().get('/live/')).status_code, 503)
+
+    def test_streams_catch_up_from_the_page_versions(self):
+        live.DELTA_BUILDERS['live_test'] = lambda changes: [('keys', [c['keys'] for c in changes])]
+        self.addCleanup(live.DELTA_BUILDERS.pop, 'live_test')
+        invalidation.subscribe('live_test', live._on_change)
+        self.addCleanup(invalidation._subscribers['live_test'].remove, live._on_change)
+
+        page = invalidation.version('live_test')
+        invalidation.changed('live_test', [{'imo': 1}], 'INSERT')
+        invalidation.changed('live_test', [{'imo': 2}], 'INSERT')
+        current = invalidation.version('live_test')
+        self.assertEqual(live.parse_since(f'live_test.{page},other.1,live_test'), {'live_test': page})
+
+        events = live.stream({'live_test': page})
+        self.assertEqual(next(events), 'retry: 5000\n\n')
+        self.assertEqual(next(events), f'id: live_test.{current}\nevent: keys\ndata: [[{{"imo":1}}],[{{"imo":2}}]]\n\n')
+        self.assertEqual(next(events), ': keep-alive\n\n')
+        events.close()
+
+        events = live.stream({'live_test': current})
+        next(events)
+        self.assertEqual(next(events), ': keep-alive\n\n')
+        events.close()
+
+        # Older than the history: resynced as if any row changed
+        events = live.stream({'live_test': page - 1})
+        next(events)
+        self.assertEqual(next(events), f'id: live_test.{current}\nevent: keys\ndata: [null]\n\n')
+        events.close()
+
+
+class TableFragmentTest(TestCase):
+    def test_rows_render_like_the_template_loop(self):
+        rows = [(9100001, '<Aurora & Co>', None, 0, Decimal('12.50'), 3.25, date(2021, 5, 4), timezone.now())]
+        loop = Template(
+            "{% for row in rows %}<tr>{% for val in row %}<td>{{ val|default:'0' }}</td>{% endfor %}</tr>\n{% endfor %}"
+        )
+        self.assertEqual(tables.render_rows(rows), loop.render(Context({'rows': rows})))
+        self.assertIn("window.location='/emissions/imo/9100001'", tables.render_rows(rows, '/emissions/imo/{}'))
+
+    def test_pages_are_cached_until_their_table_changes(self):
+        statements.register('test_table_count', 'SELECT 3')
+        statements.register('test_table_page', "SELECT * FROM (VALUES (1, 'a'), (2, 'b'), (3, 'c')) AS v OFFSET %s LIMIT %s")
+        page = tables.page('test_table_page', 'test_table_count', 5, 2, ['fact'])
+        self.assertEqual((page.page, page.num_pages, page.count), (2, 2, 3))
+        self.assertEqual(page.rows, '<tr><td>3</td><td>c</td></tr>\n')
+        with self.assertNumQueries(0):
+            self.assertEqual(tables.page('test_table_page', 'test_table_count', 2, 2, ['fact']), page)
+
+        invalidation.changed('fact')
+        with self.assertNumQueries(2):
+            tables.page('test_table_page', 'test_table_count', 2, 2, ['fact'])
+
+    def test_pages_are_cached_per_language(self):
+        statements.register('test_table_count', 'SELECT 3')
+        statements.register('test_table_page', "SELECT * FROM (VALUES (1, 'a'), (2, 'b'), (3, 'c')) AS v OFFSET %s LIMIT %s")
+        tables.page('test_table_page', 'test_table_count', 1, 2, ['fact'])
+        with translation.override('de'), self.assertNumQueries(1):
+            tables.page('test_table_page', 'test_table_count', 1, 2, ['fact'])
@@ -0,0 +1,195 @@
+"""
+Best and worst k ships per (ship_type, year) by EEDI and by time at sea.
+
+`ship_topk` holds, for every cell, the k ships with the lowest and highest
+average EEDI and average total time at sea (year 0 is the cell over all
+years). A statement trigger on `fact` recomputes the cells a write touches,
+once per statement, so the ranking charts are a primary key lookup instead of
+a window over all of fact.
+Unlike RANK(), positions are unique: ties are broken by ship name, so a cell
+never holds more than k ships per ranking.
+"""
+from django.conf import settings
+from django.db import connections, transaction
+
+from app.utils import namedtuplefetchall
+
+ALL_YEARS = 0
+METRICS = {
+    'eedi': 'avg_eedi',
+    'time_sea': 'avg_time_sea',
+}
+DIRECTIONS = {
+    'lowest': 'ASC',
+    'highest': 'DESC',
+}
+
+CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS ship_topk (
+        ship_type TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        direction TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        ship_name TEXT,
+        avg_eedi DOUBLE PRECISION,
+        avg_time_sea DOUBLE PRECISION,
+        PRIMARY KEY (metric, direction, year, ship_type, position)
+    );
+    CREATE INDEX IF NOT EXISTS fact_ship_id_idx ON fact (ship_id);
+    CREATE INDEX IF NOT EXISTS ship_dim_ship_type_idx ON ship_dim (ship_type);
+'''
+
+def _touched(*tables):
+    """Returns the query of the cells, and their all-years cells, the rows of the transition tables fall in"""
+    return ' UNION '.join(
+        f'''
+            SELECT s.ship_type::TEXT AS ship_type, d.year::INTEGER AS year
+            FROM {table} f, ship_dim s, date_dim d
+            WHERE f.ship_id = s.ship_id AND f.date_id = d.date_id
+            UNION
+            SELECT s.ship_type::TEXT, {ALL_YEARS}
+            FROM {table} f, ship_dim s, date_dim d
+            WHERE f.ship_id = s.ship_id AND f.date_id = d.date_id
+        '''
+        for table in tables
+    )
+
+
+def _refresh_cells(*tables):
+    # In lock order, so writers touching the same cells cannot deadlock
+    return f'''
+        PERFORM ship_topk_refresh(cells.ship_type, cells.year)
+        FROM (
+            SELECT * FROM ({_touched(*tables)}) t
+            WHERE ship_type IS NOT NULL AND year IS NOT NULL
+            ORDER BY hashtext(ship_type), year
+        ) cells;
+    '''
+
+
+# Statement level, with the changed rows in transition tables, so a bulk
+# load refreshes each cell it touches once instead of once per row
+CREATE_TRIGGER_FUNCTION = f'''
+    CREATE OR REPLACE FUNCTION ship_topk_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {_refresh_cells('new_rows')}
+        ELSIF TG_OP = 'UPDATE' THEN
+            {_refresh_cells('old_rows', 'new_rows')}
+        ELSE
+            {_refresh_cells('old_rows')}
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+CREATE_TRIGGER = '''
+    DROP TRIGGER IF EXISTS ship_topk ON fact;
+    DROP TRIGGER IF EXISTS ship_topk_insert ON fact;
+    DROP TRIGGER IF EXISTS ship_topk_update ON fact;
+    DROP TRIGGER IF EXISTS ship_topk_delete ON fact;
+    CREATE TRIGGER ship_topk_insert
+    AFTER INSERT ON fact REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE ship_topk_trigger();
+    CREATE TRIGGER ship_topk_update
+    AFTER UPDATE ON fact REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE ship_topk_trigger();
+    CREATE TRIGGER ship_topk_delete
+    AFTER DELETE ON fact REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE ship_topk_trigger();
+'''
+
+
+def _ranked(metric, direction, k):
+    column = METRICS[metric]
+    return f'''
+        (SELECT '{metric}', '{direction}',
+                ROW_NUMBER() OVER (ORDER BY {column} {DIRECTIONS[direction]}, ship_name),
+                ship_name, avg_eedi, avg_time_sea
+         FROM ships
+         WHERE {column} IS NOT NULL
+         ORDER BY {column} {DIRECTIONS[direction]}, ship_name
+         LIMIT {k})
+    '''
+
+
+def _refresh_function(k):
+    ranked = ' UNION ALL '.join(
+        _ranked(metric, direction, k) for metric in METRICS for direction in DIRECTIONS
+    )
+    return f'''
+        CREATE OR REPLACE FUNCTION ship_topk_refresh(p_ship_type TEXT, p_year INTEGER)
+        RETURNS void AS $$
+        BEGIN
+            -- Serializes concurrent writers refreshing the same cell
+            PERFORM pg_advisory_xact_lock(hashtext(p_ship_type), p_year);
+            DELETE FROM ship_topk WHERE ship_type = p_ship_type AND year = p_year;
+            INSERT INTO ship_topk (metric, direction, position, ship_name, avg_eedi, avg_time_sea, ship_type, year)
+            WITH ships AS (
+                SELECT s.ship_name::TEXT AS ship_name,
+                       AVG(f.eedi)::DOUBLE PRECISION AS avg_eedi,
+                       AVG(f.total_time_sea)::DOUBLE PRECISION AS avg_time_sea
+                FROM ship_dim s, fact f, date_dim d
+                WHERE s.ship_type = p_ship_type AND f.ship_id = s.ship_id AND d.date_id = f.date_id
+                  AND (p_year = {ALL_YEARS} OR d.year = p_year)
+                GROUP BY s.ship_id, s.ship_name
+            )
+            SELECT ranked.*, p_ship_type, p_year FROM ({ranked}) ranked;
+        END;
+        $$ LANGUAGE plpgsql;
+    '''
+
+
+REBUILD = f'''
+    SELECT ship_topk_refresh(cells.ship_type, cells.year)
+    FROM (
+        SELECT DISTINCT s.ship_type::TEXT AS ship_type, d.year::INTEGER AS year
+        FROM fact f, ship_dim s, date_dim d
+        WHERE f.ship_id = s.ship_id AND f.date_id = d.date_id
+        UNION
+        SELECT DISTINCT s.ship_type::TEXT, {ALL_YEARS}
+        FROM fact f, ship_dim s
+        WHERE f.ship_id = s.ship_id
+    ) cells;
+'''
+
+
+def get_k():
+    return getattr(settings, 'SHIP_TOPK_K', 3)
+
+
+def install(using='default'):
+    """Creates the top-k table and the trigger keeping it up to date for the configured k"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(CREATE_TABLE)
+        cursor.execute(_refresh_function(get_k()))
+        cursor.execute(CREATE_TRIGGER_FUNCTION)
+        cursor.execute(CREATE_TRIGGER)
+
+
+def rebuild(using='default'):
+    """Recomputes every cell of the top-k table from the fact table"""
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('LOCK TABLE fact IN SHARE MODE;')
+            cursor.execute('DELETE FROM ship_topk;')
+            cursor.execute(REBUILD)
+
+
+def lookup(metric, direction, year=ALL_YEARS, k=None, using='default'):
+    """
+    Returns the top k rows of every ship type for the metric and direction,
+    ordered by ship type and position.
+    """
+    if metric not in METRICS or direction not in DIRECTIONS:
+        raise ValueError(f'Unknown top-k ranking {direction} {metric}')
+    with connections[using].cursor() as cursor:
+        cursor.execute('''
+            SELECT ship_type, position, ship_name, avg_eedi, avg_time_sea
+            FROM ship_topk
+            WHERE metric = %s AND direction = %s AND year = %s AND position <= %s
+            ORDER BY ship_type, position
+        ''', [metric, direction, year, k or get_k()])
+        return namedtuplefetchall(cursor)
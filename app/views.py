@@ -1,18 +1,20 @@
+from itertools import groupby
+
 from django.shortcuts import render
-from django.db import connections
+from django.db import connections, transaction
 from django.shortcuts import redirect
-from django.http import Http404
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.db.utils import IntegrityError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from plotly.offline import plot
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-
-from app.utils import namedtuplefetchall, clamp
+from app.utils import namedtuplefetchall
 from app.forms import ImoForm
+from app.routers import read_db, write_db
+from app.invalidation import version
+from app import cube, dashboards, figures, greetings, live, records, regression, sketches, statements, tables, topk
 
 import numpy as np
-from sklearn.linear_model import LinearRegression
 
 PAGE_SIZE = 20
 COLUMNS = [
@@ -73,6 +75,37 @@ COLUMNS6= [
 ]
 
 
+AGGREGATES = 'count(distinct c.imo), c.ship_type, min(c.technical_efficiency_number), avg(c.technical_efficiency_number), max(c.technical_efficiency_number)'
+
+
+def register_page_statements(table, columns):
+    """Registers the row count and, per order_by column, the page query of a table page"""
+    statements.register(f'{table}_count', f'SELECT COUNT(*) FROM {table}')
+    for col in columns:
+        statements.register(f'{table}_page_by_{col}', f'''
+            SELECT {", ".join(columns)}
+            FROM {table}
+            ORDER BY {col}
+            OFFSET %s
+            LIMIT %s
+        ''')
+
+
+register_page_statements('co2emission_reduced', COLUMNS)
+register_page_statements('fact', COLUMNS3)
+register_page_statements('ship_dim', COLUMNS4)
+register_page_statements('verifier_dim', COLUMNS5)
+register_page_statements('date_dim', COLUMNS6)
+statements.register('aggregation_count', f'select {AGGREGATES} from co2emission_reduced as c group by c.ship_type;')
+statements.register('aggregation_page', f'''
+    SELECT {AGGREGATES}
+    FROM co2emission_reduced as c
+    GROUP BY c.ship_type
+    OFFSET %s
+    LIMIT %s
+''')
+
+
 def index(request):
     """Shows the main page"""
     context = {'nbar': 'home'}
@@ -81,12 +114,17 @@ def index(request):
 
 def db(request):
     """Shows very simple DB page"""
-    with connections['default'].cursor() as cursor:
-        cursor.execute('INSERT INTO app_greeting ("when") VALUES (NOW());')
-        cursor.execute('SELECT "when" FROM app_greeting;')
-        greetings = namedtuplefetchall(cursor)
-
-    context = {'greetings': greetings, 'nbar': 'db'}
+    # Written in batches by app.greetings; the page shows the newest ones only
+    greetings.add()
+    try:
+        before = parse_datetime(request.GET.get('before', ''))
+    except ValueError:
+        before = None
+    if before is not None and timezone.is_naive(before):
+        before = timezone.make_aware(before)
+    rows = greetings.recent(before=before, using=read_db())
+
+    context = {'greetings': rows, 'nbar': 'db', 'older': rows[-1]['when'] if rows else None}
     return render(request, 'db.html', context)
 
 def aggregation(request, page=1):
@@ -95,21 +133,9 @@ def aggregation(request, page=1):
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS else 'imo'
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute('select count(distinct c.imo), c.ship_type, min(c.technical_efficiency_number), avg(c.technical_efficiency_number), max(c.technical_efficiency_number) from co2emission_reduced as c group by c.ship_type;')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
-
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT {"count(distinct c.imo), c.ship_type, min(c.technical_efficiency_number), avg(c.technical_efficiency_number), max(c.technical_efficiency_number)"}
-	    FROM co2emission_reduced as c
-            GROUP BY c.ship_type
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    # Read before the page, which reflects these versions at least
+    live_since = live.format_since({'co2emission_reduced': version('co2emission_reduced')})
+    table = tables.page('aggregation_page', 'aggregation_count', page, PAGE_SIZE, ['co2emission_reduced'], using=read_db())
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -117,11 +143,12 @@ def aggregation(request, page=1):
 
     context = {
         'nbar': 'aggregation',
-        'page': page,
-        'rows': rows,
-        'num_pages': num_pages,
+        'page': table.page,
+        'rows': table.rows,
+        'num_pages': table.num_pages,
         'msg': msg,
-        'order_by': order_by
+        'order_by': order_by,
+        'live_since': live_since,
     }
     return render(request, 'aggregation.html', context)
 
@@ -132,21 +159,11 @@ def emissions(request, page=1):
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS else 'imo'
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT COUNT(*) FROM co2emission_reduced')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
-
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT {", ".join(COLUMNS)}
-            FROM co2emission_reduced
-            ORDER BY {order_by}
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    live_since = live.format_since({'co2emission_reduced': version('co2emission_reduced')})
+    table = tables.page(
+        f'co2emission_reduced_page_by_{order_by}', 'co2emission_reduced_count', page, PAGE_SIZE,
+        ['co2emission_reduced'], link='/emissions/imo/{}', using=read_db(),
+    )
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -154,11 +171,13 @@ def emissions(request, page=1):
 
     context = {
         'nbar': 'emissions',
-        'page': page,
-        'rows': rows,
-        'num_pages': num_pages,
+        'page': table.page,
+        'rows': table.rows,
+        'num_pages': table.num_pages,
+        'count': table.count,
         'msg': msg,
-        'order_by': order_by
+        'order_by': order_by,
+        'live_since': live_since,
     }
     return render(request, 'emissions.html', context)
 
@@ -179,20 +198,25 @@ def insert_update_values(form, post, action, imo):
     if action == 'update':
         # Remove imo from updated fields
         cols, values = cols[1:], values[1:]
-        with connections['default'].cursor() as cursor:
+        with transaction.atomic(using=write_db()), connections[write_db()].cursor() as cursor:
             cursor.execute(f'''
                 UPDATE co2emission_reduced
                 SET {", ".join(f"{col} = %s" for col in cols)}
-                WHERE imo = %s;
+                WHERE imo = %s
+                RETURNING *;
             ''', [*values, imo])
+            rows = namedtuplefetchall(cursor)
+            records.written(imo, rows[0]._asdict() if rows else None, 'UPDATE', using=write_db())
         return True, '✔ IMO updated successfully'
 
     # Else insert
-    with connections['default'].cursor() as cursor:
+    with transaction.atomic(using=write_db()), connections[write_db()].cursor() as cursor:
         cursor.execute(f'''
             INSERT INTO co2emission_reduced ({", ".join(cols)})
-            VALUES ({", ".join(["%s"] * len(cols))});
+            VALUES ({", ".join(["%s"] * len(cols))})
+            RETURNING *;
         ''', values)
+        records.written(imo, namedtuplefetchall(cursor)[0]._asdict(), 'INSERT', using=write_db())
     return True, '✔ IMO inserted successfully'
 
 
@@ -218,8 +242,9 @@ def emission_detail(request, imo=None):
         action = request.POST.get('action', None)
 
         if action == 'delete':
-            with connections['default'].cursor() as cursor:
+            with transaction.atomic(using=write_db()), connections[write_db()].cursor() as cursor:
                 cursor.execute('DELETE FROM co2emission_reduced WHERE imo = %s;', [imo])
+                records.written(imo, None, 'DELETE', using=write_db())
             return redirect(f'/emissions?deleted={imo}')
         try:
             success, msg = insert_update_values(form, request.POST, action, imo)
@@ -230,12 +255,11 @@ def emission_detail(request, imo=None):
         except Exception as e:
             success, msg = False, f'Some unhandled error occured: {e}'
     elif imo:  # GET request and imo is set
-        with connections['default'].cursor() as cursor:
-            cursor.execute('SELECT * FROM co2emission_reduced WHERE imo = %s', [imo])
-            try:
-                initial_values = namedtuplefetchall(cursor)[0]._asdict()
-            except IndexError:
-                raise Http404(f'IMO {imo} not found')
+        # Served from the record cache, unknown IMOs included; misses read
+        # the primary so a lagging replica is never cached (see app.records)
+        initial_values = records.get(imo)
+        if initial_values is None:
+            raise Http404(f'IMO {imo} not found')
 
     # Set dates (if present) to iso format, necessary for form
     # We don't use this in class, but you will need it for your project
@@ -259,15 +283,15 @@ def emission_detail(request, imo=None):
     return render(request, 'emission_detail.html', context)
 
 
-def visual(request):
+def visual_context():
     """ 
-    View demonstrating how to display a graph object
-    on a web page with Plotly. 
+    Builds the plots of the visual page, demonstrating how to display
+    a graph object on a web page with Plotly. 
     """
     
     #cursor = conn.cursor()    
  
-    with connections['default'].cursor() as cursor:
+    with connections[read_db()].cursor() as cursor:
         cursor.execute('select count(distinct c.imo), c.ship_type, min(c.technical_efficiency_number), avg(c.technical_efficiency_number), max(c.technical_efficiency_number) from co2emission_reduced as c group by c.ship_type;')
         rows = cursor.fetchall() #if this is here, indented, then its fine
 
@@ -288,9 +312,9 @@ def visual(request):
     # Each object will contain on series of data.
     graphs = []
     
-    fig1 = go.Bar(x=li_name,y=li_avg) 
+    fig1 = figures.bar(x=li_name,y=li_avg) 
 
-    fig2 = go.Pie(labels=li_name,values=li_max) 
+    fig2 = figures.pie(labels=li_name,values=li_max) 
 	
     # Adding linear plot of y1 vs. x.
     #graphs.append(
@@ -315,13 +339,11 @@ def visual(request):
     }
 
     # Getting HTML needed to render the plot.
-    plot_div = plot({'data': fig1, 'layout': layout}, 
-                    output_type='div')
-    plot_div2 = plot({'data': fig2, 'layout': layout2}, 
-                    output_type='div')
+    plot_div = figures.figure_div(fig1, layout)
+    plot_div2 = figures.figure_div(fig2, layout2)
 
     #new part for the group project***********************************************
-    with connections['default'].cursor() as cursor:
+    with connections[read_db()].cursor() as cursor:
         cursor.execute('select f.total_co2, f.total_time_sea, f.total_fuel_consmp from fact as f;')
         rows2 = cursor.fetchall() #if this is here, indented, then its fine
 
@@ -333,23 +355,23 @@ def visual(request):
         tts_li.append(rows2[i][1]) 
         tfc_li.append(rows2[i][2])
 
-    fig3 = go.Scatter(x=np.log10(tts_li),y=np.log10(co2_li), mode='markers',name='log10 total co2') 
-    fig4 = go.Scatter(x=np.log10(tts_li),y=np.log10(tfc_li), mode='markers',name='log10 total time at sea') 
+    # The points go to the page as binary float arrays (see app.figures)
+    log_tts = np.log10(np.asarray(tts_li, dtype=float))
+    fig3 = figures.scatter(x=log_tts,y=np.log10(np.asarray(co2_li, dtype=float)), mode='markers',name='log10 total co2') 
+    fig4 = figures.scatter(x=log_tts,y=np.log10(np.asarray(tfc_li, dtype=float)), mode='markers',name='log10 total time at sea') 
     
-    lr=LinearRegression().fit(np.log10(tts_li).reshape(-1,1),np.log10(co2_li).reshape(-1,1))
-    lr_y_pred = lr.predict(np.log10(tts_li).reshape(-1,1))  
-    lr_y_pred_li=[]
-    for i in range(len(lr_y_pred)):
-        lr_y_pred_li.append(lr_y_pred[i][0])
-
-    fig3_lr= go.Scatter(x=np.log10(tts_li),y=lr_y_pred_li,line=dict(color='firebrick', width=4), name='linear regression')  
-
-    lr2=LinearRegression().fit(np.log10(tts_li).reshape(-1,1),np.log10(tfc_li).reshape(-1,1))
-    lr2_y_pred = lr2.predict(np.log10(tts_li).reshape(-1,1))  
-    lr2_y_pred_li=[]
-    for i in range(len(lr2_y_pred)):
-        lr2_y_pred_li.append(lr2_y_pred[i][0])
-    fig4_lr= go.Scatter(x=np.log10(tts_li),y=lr2_y_pred_li,line=dict(color='firebrick', width=4),name='linear regression')  
+    # Regression lines come from the running sums kept by app.regression,
+    # so only the markers need the raw points
+    fits = regression.get_fits(using=read_db())
+    log_tts_ends = [log_tts.min(), log_tts.max()] if len(log_tts) else []
+
+    data3, data4 = [fig3], [fig4]
+    if fits['co2'] is not None:
+        fig3_lr= figures.scatter(x=log_tts_ends,y=fits['co2'].predict(log_tts_ends),line=dict(color='firebrick', width=4), name='linear regression')
+        data3.append(fig3_lr)
+    if fits['fuel'] is not None:
+        fig4_lr= figures.scatter(x=log_tts_ends,y=fits['fuel'].predict(log_tts_ends),line=dict(color='firebrick', width=4),name='linear regression')
+        data4.append(fig4_lr)
 
     layout3 = {
         'title': 'Log_10(Total time at sea) versus Log_10(Total Co2)',
@@ -366,13 +388,13 @@ def visual(request):
         'height': 620,
         'width': 560,
     }
-    plot_div3 = plot({'data':[fig3, fig3_lr], 'layout': layout3}, 
-                    output_type='div')
-    plot_div4 = plot({'data': [fig4, fig4_lr], 'layout': layout4}, 
-                    output_type='div')
+    # Stable ids so live updates (app.live) can find the charts
+    plot_div3 = figures.figure_div(data3, layout3, div_id=live.SCATTER_DIVS['co2'])
+    plot_div4 = figures.figure_div(data4, layout4, div_id=live.SCATTER_DIVS['fuel'])
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute('select avg(f.total_co2), avg(f.total_time_sea), s.ship_type from fact as f, ship_dim as s where f.ship_id = s.ship_id group by s.ship_type;')
+    with connections[read_db()].cursor() as cursor:
+        # The same statement feeds the live updates of these charts
+        statements.execute(cursor, 'ship_type_averages')
         rows3 = cursor.fetchall() #if this is here, indented, then its fine
     
     avg_co2_li=[]
@@ -383,8 +405,8 @@ def visual(request):
         avg_tts_li.append(rows3[i][1]) 
         ship_type_li.append(rows3[i][2])
 
-    fig5 = go.Bar(x=ship_type_li,y=avg_co2_li) 
-    fig6 = go.Pie(labels=ship_type_li,values=avg_tts_li) 
+    fig5 = figures.bar(x=ship_type_li,y=avg_co2_li) 
+    fig6 = figures.pie(labels=ship_type_li,values=avg_tts_li) 
 
     layout5 = {
         'title': 'average total co2 bar chart by ship type',
@@ -400,13 +422,60 @@ def visual(request):
         'height': 620,
         'width': 560,
     }
-    plot_div5 = plot({'data': fig5, 'layout': layout5}, 
-                    output_type='div')
-    plot_div6 = plot({'data': fig6, 'layout': layout6}, 
-                    output_type='div')
-    return render(request, 'visual.html', 
-                  context={'plot_div': plot_div,'plot_div2':plot_div2,'plot_div3':plot_div3, 'plot_div4':plot_div4, 'plot_div5':plot_div5, 'plot_div6':plot_div6, 'nbar': 'visual'})
+    plot_div5 = figures.figure_div(fig5, layout5, div_id=live.CO2_BAR_DIV)
+    plot_div6 = figures.figure_div(fig6, layout6, div_id=live.TIME_SEA_PIE_DIV)
+    return {'plot_div': plot_div,'plot_div2':plot_div2,'plot_div3':plot_div3, 'plot_div4':plot_div4, 'plot_div5':plot_div5, 'plot_div6':plot_div6}
+
+
+dashboards.register('visual', visual_context, tables=['co2emission_reduced', 'fact', 'ship_dim'])
+
 
+def visual(request):
+    """Shows the visual page, rebuilt in the background when the data changes"""
+    context, versions = dashboards.get_with_versions('visual')
+    context = {
+        **context,
+        'nbar': 'visual',
+        'plotly_js_url': figures.PLOTLY_JS_URL,
+        'live_since': live.format_since(versions),
+    }
+    return render(request, 'visual.html', context)
+
+
+def live_updates(request):
+    """Streams the live chart and table deltas as Server-Sent Events (see app.live)"""
+    # EventSource sends the id of the last event it got when it reconnects
+    since = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('since')
+    events = live.stream(live.parse_since(since))
+    if events is None:
+        response = HttpResponse(status=503)
+        response['Retry-After'] = str(live.FULL_RETRY_SECONDS)
+        return response
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def regression_fits(request):
+    """Returns the overall and per ship type regression fits as JSON"""
+    year = request.GET.get('year', None)
+    year = int(year) if year and year.isdigit() else None
+
+    def as_dict(fits):
+        return {
+            target: fit._asdict() if fit is not None else None
+            for target, fit in fits.items()
+        }
+
+    by_ship_type = regression.fits_by_ship_type(year=year, using=read_db())
+    return JsonResponse({
+        'year': year,
+        'all': as_dict(regression.get_fits(year=year, using=read_db())),
+        'ship_types': {
+            ship_type: as_dict(fits) for ship_type, fits in by_ship_type.items()
+        },
+    })
 
 
 def fact(request, page=1):
@@ -415,21 +484,8 @@ def fact(request, page=1):
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS3 else 'ship_id'
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT COUNT(*) FROM fact')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
-
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT {", ".join(COLUMNS3)}
-            FROM fact
-	    ORDER BY {order_by}
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    live_since = live.format_since({'fact': version('fact')})
+    table = tables.page(f'fact_page_by_{order_by}', 'fact_count', page, PAGE_SIZE, ['fact'], using=read_db())
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -437,11 +493,13 @@ def fact(request, page=1):
 
     context = {
         'nbar': 'fact',
-        'page': page,
-        'rows': rows,
-        'num_pages': num_pages,
+        'page': table.page,
+        'rows': table.rows,
+        'num_pages': table.num_pages,
+        'count': table.count,
         'msg': msg,
-        'order_by': order_by
+        'order_by': order_by,
+        'live_since': live_since,
     }
     return render(request, 'fact.html', context)
 
@@ -453,21 +511,7 @@ def ship_dim(request, page=1):
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS4 else 'ship_id'
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT COUNT(*) FROM ship_dim')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
-
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT {", ".join(COLUMNS4)}
-            FROM ship_dim
-	    ORDER BY {order_by}
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    table = tables.page(f'ship_dim_page_by_{order_by}', 'ship_dim_count', page, PAGE_SIZE, ['ship_dim'], using=read_db())
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -475,9 +519,9 @@ def ship_dim(request, page=1):
 
     context = {
         'nbar': 'ship_dim',
-        'page': page,
-        'rows': rows,
-        'num_pages': num_pages,
+        'page': table.page,
+        'rows': table.rows,
+        'num_pages': table.num_pages,
         'msg': msg,
 	'order_by': order_by
     }
@@ -485,46 +529,38 @@ def ship_dim(request, page=1):
 
 
 
-def adv_q_visual(request):
+def adv_q_visual_context():
     """ 
-    View demonstrating how to display a graph object
-    on a web page with Plotly. 
+    Builds the plots of the advanced query page, demonstrating how to display
+    a graph object on a web page with Plotly. 
     """
     
     #cursor = conn.cursor()    
  
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT d.Year, s.ship_type,ROUND(PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC, 2) AS percentile_25, ROUND(PERCENTILE_CONT(0.50) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC, 2) AS percentile_50, ROUND(PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC, 2) AS percentile_75, ROUND(PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY f.eedi ASC)::NUMERIC, 2) AS percentile_95 FROM fact f, ship_dim s, date_dim d WHERE f.ship_id= s.ship_id AND d.date_id = f.date_id GROUP BY ROLLUP(d.Year, s.ship_type);')
-        rows = cursor.fetchall() #if this is here, indented, then its fine
-
-    #print(str(rows))
-    # Generating some data for plots.
-    year_li=[2019,2020,2021]
+    # Percentiles per year over all ship types, merged from the EEDI sketches
+    # kept per (year, ship_type) instead of sorting fact.eedi per group
+    percentiles = sketches.rollup(sketches.load(using=read_db()))
+    year_li = sorted(year for year, ship_type in percentiles if year is not None and ship_type is None)
     eedi_agg_25pc_li=[]
     eedi_agg_50pc_li=[]
     eedi_agg_75pc_li=[]
     eedi_agg_95pc_li=[]
 
-    eedi_agg_25pc_li.append(rows[8][2])
-    eedi_agg_25pc_li.append(rows[17][2])
-    eedi_agg_25pc_li.append(rows[27][2])
-
-    eedi_agg_50pc_li.append(rows[8][3])
-    eedi_agg_50pc_li.append(rows[17][3])
-    eedi_agg_50pc_li.append(rows[27][3])
-
-    eedi_agg_75pc_li.append(rows[8][4])
-    eedi_agg_75pc_li.append(rows[17][4])
-    eedi_agg_75pc_li.append(rows[27][4])
-
-    eedi_agg_95pc_li.append(rows[8][5])
-    eedi_agg_95pc_li.append(rows[17][5])
-    eedi_agg_95pc_li.append(rows[27][5])
+    for year in year_li:
+        # An empty digest has no quantiles; plot those years as gaps
+        p25, p50, p75, p95 = [
+            None if q is None else round(q, 2)
+            for q in percentiles[(year, None)].quantiles([0.25, 0.50, 0.75, 0.95])
+        ]
+        eedi_agg_25pc_li.append(p25)
+        eedi_agg_50pc_li.append(p50)
+        eedi_agg_75pc_li.append(p75)
+        eedi_agg_95pc_li.append(p95)
  
-    fig1a = go.Scatter(x=year_li,y=eedi_agg_25pc_li,name='25th percentile') 
-    fig1b = go.Scatter(x=year_li,y=eedi_agg_50pc_li,name='50th percentile') 
-    fig1c = go.Scatter(x=year_li,y=eedi_agg_75pc_li,name='75th percentile') 
-    fig1d = go.Scatter(x=year_li,y=eedi_agg_95pc_li) 
+    fig1a = figures.scatter(x=year_li,y=eedi_agg_25pc_li,name='25th percentile') 
+    fig1b = figures.scatter(x=year_li,y=eedi_agg_50pc_li,name='50th percentile') 
+    fig1c = figures.scatter(x=year_li,y=eedi_agg_75pc_li,name='75th percentile') 
+    fig1d = figures.scatter(x=year_li,y=eedi_agg_95pc_li) 
 
     # Setting layout of the figure.
     layout = {
@@ -545,85 +581,84 @@ def adv_q_visual(request):
 
 
     # Getting HTML needed to render the plot.
-    plot_div = plot({'data': [fig1a,fig1b,fig1c], 'layout': layout}, 
-                    output_type='div')
-    plot_div_E = plot({'data': [fig1d], 'layout': layout_E}, 
-                    output_type='div')
+    plot_div = figures.figure_div([fig1a,fig1b,fig1c], layout)
+    plot_div_E = figures.figure_div([fig1d], layout_E)
 
 #************** second advanced query visualization ************************
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT rank_filter.* FROM (SELECT s.ship_name, s.ship_type, f.eedi,RANK() OVER (PARTITION BY s.ship_type ORDER BY f.eedi) FROM fact f, ship_dim s, date_dim d WHERE f.ship_id= s.ship_id AND d.date_id = f.date_id AND d.Year = 2021 ) rank_filter WHERE RANK <=3;')
-        rows2 = cursor.fetchall() #if this is here, indented, then its fine
-    
-    name_li=[]
-    eedi_li=[]
-    type_li=[]
+    # Both rankings are lookups in the ship_topk summary kept by app.topk
+    k = topk.get_k()
+    rows2 = topk.lookup('eedi', 'lowest', year=2021, using=read_db())
 
-    for i in range(len(rows2)):
-        name_li.append(rows2[i][0])
-        eedi_li.append(rows2[i][2])    
-        type_li.append(rows2[i][1])
-
-    fig2a=go.Bar(x=name_li[0:3],y=eedi_li[0:3],name=type_li[0])  
-    fig2b=go.Bar(x=name_li[3:6],y=eedi_li[3:6],name=type_li[4]) 
-    fig2c=go.Bar(x=[name_li[6]],y=[eedi_li[6]],name=type_li[6]) 
-    fig2d=go.Bar(x=name_li[7:10],y=eedi_li[7:10],name=type_li[8]) 
-    fig2e=go.Bar(x=name_li[10:13],y=eedi_li[10:13],name=type_li[10]) 
-    fig2f=go.Bar(x=name_li[13:16],y=eedi_li[13:16],name=type_li[13]) 
-    fig2g=go.Bar(x=name_li[16:19],y=eedi_li[16:19],name=type_li[16]) 
-    fig2h=go.Bar(x=name_li[19:21],y=eedi_li[19:21],name=type_li[19]) 
-    fig2i=go.Bar(x=[name_li[21]],y=[eedi_li[21]],name=type_li[21]) 
+    bars2 = []
+    for ship_type, group in groupby(rows2, key=lambda row: row.ship_type):
+        group = list(group)
+        bars2.append(figures.bar(x=[row.ship_name for row in group],y=[row.avg_eedi for row in group],name=ship_type))
 
     layout2 = {
-        'title': 'top 3 lowest eedi ships from each ship category'  ,
+        'title': f'top {k} lowest eedi ships from each ship category'  ,
         'xaxis_title': 'ship name',
         'yaxis_title': 'EEDI',
         'height': 620,
         'width': 700,
     }  
-    plot_div2=plot({'data': [fig2a,fig2b,fig2c,fig2d,fig2e,fig2f,fig2g,fig2h,fig2i], 'layout': layout2}, 
-                    output_type='div')
+    plot_div2=figures.figure_div(bars2, layout2)
 
 #********************** do the third advanced query here
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT rank_filter.* FROM ( SELECT s.ship_name, s.ship_type, sum_f.avg_ship, sum_f.avg_time, RANK() OVER ship_time AS time_rank, ROUND(AVG(sum_f.avg_ship) OVER ship_eedi::NUMERIC, 2) AS avg_type FROM ship_dim s, (SELECT f1.ship_id, ROUND(AVG(f1.total_time_sea)::NUMERIC, 2) AS avg_time, ROUND(AVG(f1.eedi)::NUMERIC, 2) AS avg_ship FROM fact f1 GROUP BY f1.ship_id) sum_f WHERE sum_f.ship_id= s.ship_id WINDOW ship_time AS (PARTITION BY  s.ship_type ORDER BY (sum_f.avg_time) DESC), ship_eedi AS (PARTITION BY  s.ship_type ORDER BY (sum_f.avg_ship) ASC ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) ORDER BY s.ship_type) rank_filter WHERE time_rank<=3;')
-        rows3 = cursor.fetchall() #if this is here, indented, then its fine
-    
-    name_li2=[]
-    eedi_li2=[]
-    type_li2=[]
+    rows3 = topk.lookup('time_sea', 'highest', using=read_db())
 
-    for i in range(len(rows3)):
-        name_li2.append(rows3[i][0])
-        eedi_li2.append(rows3[i][2])    
-        type_li2.append(rows3[i][1])
-
-    fig3a=go.Bar(x=name_li2[0:3],y=eedi_li2[0:3],name=type_li2[0])  
-    fig3b=go.Bar(x=name_li2[3:6],y=eedi_li2[3:6],name=type_li2[4]) 
-    fig3c=go.Bar(x=[name_li2[6]],y=[eedi_li2[6]],name=type_li2[6]) 
-    fig3d=go.Bar(x=name_li2[7:10],y=eedi_li2[7:10],name=type_li2[8]) 
-    fig3e=go.Bar(x=name_li2[10:13],y=eedi_li2[10:13],name=type_li2[10]) 
-    fig3f=go.Bar(x=name_li2[13:16],y=eedi_li2[13:16],name=type_li2[13]) 
-    fig3g=go.Bar(x=name_li2[16:19],y=eedi_li2[16:19],name=type_li2[16]) 
-    fig3h=go.Bar(x=name_li2[19:21],y=eedi_li2[19:21],name=type_li2[19]) 
-    fig3i=go.Bar(x=[name_li2[21]],y=[eedi_li2[21]],name=type_li2[21]) 
-    fig3j=go.Bar(x=[name_li2[22]],y=[eedi_li2[22]],name=type_li2[22]) 
+    bars3 = []
+    for ship_type, group in groupby(rows3, key=lambda row: row.ship_type):
+        group = list(group)
+        bars3.append(figures.bar(x=[row.ship_name for row in group],y=[None if row.avg_eedi is None else round(row.avg_eedi, 2) for row in group],name=ship_type))
 
     layout3 = {
-        'title': 'top 3 highest eedi ships from each ship category'  ,
+        'title': f'eedi of the top {k} ships by time at sea from each ship category'  ,
         'xaxis_title': 'ship name',
         'yaxis_title': 'EEDI',
         'height': 620,
         'width': 700,
     }  
-    plot_div3=plot({'data': [fig3a,fig3b,fig3c,fig3d,fig3e,fig3f,fig3g,fig3h,fig3i,fig3j], 'layout': layout3}, 
-                    output_type='div')   
+    plot_div3=figures.figure_div(bars3, layout3)   
 
    
-    return render(request, 'adv_q_visual.html', 
-                  context={'plot_div': plot_div,'plot_div_E': plot_div_E, 'plot_div2': plot_div2,'plot_div3': plot_div3,'nbar': 'adv_q_visual'})
+    return {'plot_div': plot_div,'plot_div_E': plot_div_E, 'plot_div2': plot_div2,'plot_div3': plot_div3}
 
 
+dashboards.register('adv_q_visual', adv_q_visual_context, tables=['fact', 'ship_dim', 'date_dim'])
+
+
+def adv_q_visual(request):
+    """Shows the advanced query page, rebuilt in the background when the data changes"""
+    context = {**dashboards.get('adv_q_visual'), 'nbar': 'adv_q_visual', 'plotly_js_url': figures.PLOTLY_JS_URL}
+    return render(request, 'adv_q_visual.html', context)
+
+
+
+def eedi_percentiles(request):
+    """
+    Returns EEDI percentiles as JSON for every ROLLUP(year, ship_type) level,
+    e.g. /adv_q_visual/percentiles/?q=0.1&q=0.9&year=2020
+    """
+    try:
+        qs = [float(q) for q in request.GET.getlist('q')] or [0.25, 0.50, 0.75, 0.95]
+    except ValueError:
+        return JsonResponse({'error': 'q must be a number between 0 and 1'}, status=400)
+    if not all(0 <= q <= 1 for q in qs):
+        return JsonResponse({'error': 'q must be a number between 0 and 1'}, status=400)
+    year = request.GET.get('year', None)
+    ship_type = request.GET.get('ship_type', None)
+
+    results = []
+    for (cell_year, cell_type), digest in sketches.rollup(sketches.load(using=read_db())).items():
+        if (year and str(cell_year) != year) or (ship_type and cell_type != ship_type):
+            continue
+        results.append({
+            'year': cell_year,
+            'ship_type': cell_type,
+            'count': digest.count,
+            'percentiles': dict(zip(map(str, qs), digest.quantiles(qs))),
+        })
+    return JsonResponse({'results': results})
 
 
 def verifier_dim(request, page=1):
@@ -632,21 +667,7 @@ def verifier_dim(request, page=1):
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS5 else 'verifier_id'
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT COUNT(*) FROM verifier_dim')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
-
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT {", ".join(COLUMNS5)}
-            FROM verifier_dim
-	    ORDER BY {order_by}
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    table = tables.page(f'verifier_dim_page_by_{order_by}', 'verifier_dim_count', page, PAGE_SIZE, ['verifier_dim'], using=read_db())
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -654,9 +675,9 @@ def verifier_dim(request, page=1):
 
     context = {
         'nbar': 'verifier_dim',
-        'page': page,
-        'rows': rows,
-        'num_pages': num_pages,
+        'page': table.page,
+        'rows': table.rows,
+        'num_pages': table.num_pages,
         'msg': msg,
         'order_by': order_by
     }
@@ -669,21 +690,7 @@ def date_dim(request, page=1):
     order_by = request.GET.get('order_by', '')
     order_by = order_by if order_by in COLUMNS6 else 'date_id'
 
-    with connections['default'].cursor() as cursor:
-        cursor.execute('SELECT COUNT(*) FROM verifier_dim')
-        count = cursor.fetchone()[0]
-        num_pages = (count - 1) // PAGE_SIZE + 1
-        page = clamp(page, 1, num_pages)
-
-        offset = (page - 1) * PAGE_SIZE
-        cursor.execute(f'''
-            SELECT {", ".join(COLUMNS6)}
-            FROM date_dim
-	    ORDER BY {order_by}
-            OFFSET %s
-            LIMIT %s
-        ''', [offset, PAGE_SIZE])
-        rows = namedtuplefetchall(cursor)
+    table = tables.page(f'date_dim_page_by_{order_by}', 'date_dim_count', page, PAGE_SIZE, ['date_dim'], using=read_db())
 
     imo_deleted = request.GET.get('deleted', False)
     if imo_deleted:
@@ -691,10 +698,40 @@ def date_dim(request, page=1):
 
     context = {
         'nbar': 'date_dim',
-        'page': page,
-        'rows': rows,
-        'num_pages': num_pages,
+        'page': table.page,
+        'rows': table.rows,
+        'num_pages': table.num_pages,
         'msg': msg,
         'order_by': order_by
     }
-    return render(request, 'date_dim.html', context)
\ No newline at end of file
+    return render(request, 'date_dim.html', context)
+
+def cube_slice(request):
+    """
+    Answers a slice of the fact cube as JSON, e.g.
+    /cube/?by=year,ship_type&verifier_country=Germany
+    Drill down and roll up links along the date hierarchy are included.
+    """
+    by = list(dict.fromkeys(dim for dim in request.GET.get('by', 'year').split(',') if dim))
+    filters = {
+        dim: request.GET[dim] for dim in cube.DIMENSIONS if request.GET.get(dim, '') != ''
+    }
+    try:
+        rows = cube.query(by, filters, using=read_db())
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    def link(levels):
+        if levels is None:
+            return None
+        params = request.GET.copy()
+        params['by'] = ','.join(levels)
+        return f'{request.path}?{params.urlencode()}'
+
+    return JsonResponse({
+        'by': by,
+        'filters': filters,
+        'drill_down': link(cube.drill_down(by)),
+        'roll_up': link(cube.roll_up(by)),
+        'rows': [row._asdict() for row in rows],
+    })
@@ -0,0 +1,75 @@
+"""
+Compares app.figures.figure_div() with plotly.offline.plot(..., output_type='div')
+on the log10 scatter + regression line charts of the visual page.
+
+    python benchmarks/bench_figures.py [n_points ...]
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+import plotly.graph_objects as go
+from plotly.offline import plot
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import figures  # noqa: E402
+
+LAYOUT = {
+    'title': 'Log_10(Total time at sea) versus Log_10(Total Co2)',
+    'yaxis_title': 'Log_10(Total Co2)',
+    'xaxis_title': 'Log_10(Total time at sea)',
+    'height': 620,
+    'width': 560,
+}
+
+
+def make_points(n):
+    rng = np.random.default_rng(5110)
+    tts = rng.lognormal(7, 0.6, n)
+    co2 = tts * rng.lognormal(1, 0.3, n)
+    # The view gets plain Python floats from the cursor
+    return tts.tolist(), co2.tolist()
+
+
+def plotly_div(tts, co2, include_plotlyjs):
+    x, y = np.log10(tts), np.log10(co2)
+    ends = [x.min(), x.max()]
+    data = [
+        go.Scatter(x=x, y=y, mode='markers', name='log10 total co2'),
+        go.Scatter(x=ends, y=ends, line=dict(color='firebrick', width=4), name='linear regression'),
+    ]
+    return plot({'data': data, 'layout': LAYOUT}, output_type='div', include_plotlyjs=include_plotlyjs)
+
+
+def fast_div(tts, co2):
+    x = np.log10(np.asarray(tts, dtype=float))
+    y = np.log10(np.asarray(co2, dtype=float))
+    ends = [x.min(), x.max()]
+    data = [
+        figures.scatter(x=x, y=y, mode='markers', name='log10 total co2'),
+        figures.scatter(x=ends, y=ends, line=dict(color='firebrick', width=4), name='linear regression'),
+    ]
+    return figures.figure_div(data, LAYOUT)
+
+
+def bench(name, func, repeat=5):
+    number = 3
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    size = len(func())
+    print(f'  {name:<40} {best * 1000:9.2f} ms {size / 1024:10.1f} KiB')
+    return best
+
+
+def main(sizes):
+    for n in sizes:
+        tts, co2 = make_points(n)
+        print(f'{n} points')
+        bench("plot(..., output_type='div')", lambda: plotly_div(tts, co2, True))
+        base = bench("plot(..., include_plotlyjs=False)", lambda: plotly_div(tts, co2, False))
+        fast = bench('figures.figure_div()', lambda: fast_div(tts, co2))
+        print(f'  speed-up without plotly.js: {base / fast:.1f}x')
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,91 @@
+"""
+Compares the list and detail views with plain queries and with the prepared
+statements of app.statements, against the database configured in .env.
+
+    DJANGO_SETTINGS_MODULE=core.settings python benchmarks/bench_statements.py [requests]
+
+Reports the server side planning time of each query (from EXPLAIN SUMMARY)
+and the end-to-end latency of each page through the Django test client, with
+the table fragment cache (app.tables) turned off so every request runs its
+queries, and how many generic and custom plans Postgres (14+) used for each
+statement. Needs persistent connections (DB_CONN_MAX_AGE > 0), as in
+production, since statements are prepared once per connection.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connections  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from app import statements  # noqa: E402
+import app.views  # noqa: E402,F401  registers the view statements
+
+QUERIES = [
+    ('co2emission_reduced_page_by_ship_name', [200, 20]),
+    ('fact_page_by_total_co2', [200, 20]),
+    ('aggregation_page', [0, 20]),
+]
+
+PAGES = [
+    '/emissions/11?order_by=ship_name',
+    '/fact/11?order_by=total_co2',
+    '/aggregation/',
+]
+
+
+def planning_ms(cursor, sql, params):
+    cursor.execute(f'EXPLAIN (SUMMARY ON) {sql}', params)
+    for (line,) in cursor.fetchall():
+        if line.startswith('Planning Time:'):
+            return float(line.split()[2])
+
+
+def plan_times(repeat=20):
+    print('Planning time per execution (median of %d)' % repeat)
+    with connections['default'].cursor() as cursor:
+        for name, params in QUERIES:
+            statements.execute(cursor, name, params)
+            sql = statements._statements[name]
+            args = f'({", ".join(["%s"] * len(params))})'
+            plain = sorted(planning_ms(cursor, sql, params) for _ in range(repeat))[repeat // 2]
+            prepared = sorted(planning_ms(cursor, f'EXECUTE {name}{args}', params) for _ in range(repeat))[repeat // 2]
+            print(f'  {name:<40} plain {plain:7.3f} ms   prepared {prepared:7.3f} ms')
+
+
+def page_latency(client, url, number):
+    client.get(url)
+    return min(timeit.repeat(lambda: client.get(url), number=number, repeat=5)) / number
+
+
+@override_settings(TABLE_FRAGMENT_TTL=0)
+def main(number):
+    if not connections['default'].settings_dict.get('CONN_MAX_AGE'):
+        sys.exit('Set DB_CONN_MAX_AGE above 0: without persistent connections nothing stays prepared')
+    plan_times()
+    client = Client(HTTP_HOST='localhost')
+    print(f'End-to-end latency per request (best of 5 x {number})')
+    for url in PAGES:
+        with override_settings(PREPARED_STATEMENTS=False):
+            plain = page_latency(client, url, number)
+        prepared = page_latency(client, url, number)
+        print(f'  {url:<40} plain {plain * 1000:7.2f} ms   prepared {prepared * 1000:7.2f} ms'
+              f'   {plain / prepared:4.2f}x')
+
+    print('Statement counters (plans as counted by Postgres on this connection)')
+    plans = statements.server_stats()
+    for name, counters in sorted(statements.stats().items()):
+        server = plans.get(name, {})
+        print(f"  {name:<40} executions {counters['executions']:6d}   prepares {counters['prepares']:3d}"
+              f"   generic plans {server.get('generic_plans')}   custom plans {server.get('custom_plans')}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
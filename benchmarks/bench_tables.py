@@ -0,0 +1,79 @@
+"""
+Compares the `{% for val in row %}` loop the table templates used with
+app.tables.render_rows() and with a cached page fragment, on pages of
+synthetic co2emission_reduced rows. Needs no database.
+
+    DJANGO_SETTINGS_MODULE=core.settings python benchmarks/bench_tables.py [rows ...]
+"""
+import os
+import sys
+import timeit
+from datetime import date, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.template import Context, Template  # noqa: E402
+
+from app import tables  # noqa: E402
+from app.utils import namedtuplefetchall  # noqa: E402
+
+LOOP = Template('''
+      {% for row in rows %}
+        <tr style="cursor:pointer;" onclick="window.location='/emissions/imo/{{ row.imo }}'">
+          {% for val in row %}
+          <td>{{ val|default:'0' }}</td>
+          {% endfor %}
+        </tr>
+      {% endfor %}
+''')
+
+COLUMNS = ['imo', 'ship_name', 'technical_efficiency_number', 'ship_type', 'issue', 'expiry']
+
+
+class FakeCursor:
+    """Just enough of a cursor for namedtuplefetchall()"""
+    description = [(name,) for name in COLUMNS]
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+
+def make_rows(n):
+    issue = date(2019, 1, 1)
+    return [
+        (9100000 + i, f'Ship <{i}> & Co', Decimal(f'{i % 97}.{i % 10}') if i % 5 else None,
+         'Bulk carrier', issue + timedelta(days=i % 365), issue + timedelta(days=i % 365 + 1825))
+        for i in range(n)
+    ]
+
+
+def bench(name, func, repeat=5):
+    number = 20
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    print(f'  {name:<40} {best * 1e6:9.1f} us')
+    return best
+
+
+def main(sizes):
+    for n in sizes:
+        rows = make_rows(n)
+        print(f'{n} rows')
+        base = bench('template loop', lambda: LOOP.render(Context({'rows': namedtuplefetchall(FakeCursor(rows))})))
+        fast = bench('tables.render_rows()', lambda: tables.render_rows(rows, '/emissions/imo/{}'))
+        cache.set('bench-tables', str(tables.render_rows(rows, '/emissions/imo/{}')))
+        cached = bench('cached fragment', lambda: cache.get('bench-tables'))
+        print(f'  speed-up: {base / fast:.1f}x rendered, {base / cached:.0f}x cached')
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [20, 100, 1000])
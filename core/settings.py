@@ -1,5 +1,6 @@
 import os
 from decouple import config
+import dj_database_url
 import django_heroku
 
 
@@ -39,8 +40,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'app.profiling.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'app.routers.PrimaryPinningMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -53,14 +56,21 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
-            ]
+            ],
+            # Templates are compiled once per worker, in DEBUG (the default)
+            # too; restart the server to see template edits
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
         },
     }
 ]
@@ -73,6 +83,60 @@ CACHES = {
     }
 }
 
+# Upper bound on the rank error of the EEDI percentile sketches (app/sketches.py)
+EEDI_SKETCH_RANK_ERROR = config('EEDI_SKETCH_RANK_ERROR', default=0.01, cast=float)
+
+# Number of best and worst ships kept per ship type and year (app/topk.py)
+SHIP_TOPK_K = config('SHIP_TOPK_K', default=3, cast=int)
+
+# The chart pages are rebuilt in the background once their data changed or
+# their cached copy is older than DASHBOARD_MAX_AGE seconds (app/dashboards.py)
+DASHBOARD_MAX_AGE = config('DASHBOARD_MAX_AGE', default=10 * 60, cast=int)
+DASHBOARD_REFRESH_THREADS = config('DASHBOARD_REFRESH_THREADS', default=1, cast=int)
+# Seconds a request for a chart page with no cached copy waits for the worker
+# building it before building it itself
+DASHBOARD_COLD_WAIT = config('DASHBOARD_COLD_WAIT', default=5, cast=int)
+
+# Requests carrying a token from /admin/profiles/ are profiled, and a random
+# PROFILE_SAMPLE_RATE of all others. Captures are kept in PROFILE_DIR until it
+# holds more than PROFILE_MAX_BYTES (app/profiling.py)
+PROFILE_SAMPLE_RATE = config('PROFILE_SAMPLE_RATE', default=0.0, cast=float)
+PROFILE_INTERVAL_MS = config('PROFILE_INTERVAL_MS', default=5, cast=float)
+PROFILE_DIR = config('PROFILE_DIR', default=os.path.join(BASE_DIR, 'profiles'))
+PROFILE_MAX_BYTES = config('PROFILE_MAX_BYTES', default=50 * 1024 * 1024, cast=int)
+PROFILE_TOKEN_MAX_AGE = config('PROFILE_TOKEN_MAX_AGE', default=60 * 60, cast=int)
+
+# The table pages run their queries as server-side prepared statements
+# (app/statements.py); turn off behind a transaction pooling pgbouncer
+PREPARED_STATEMENTS = config('PREPARED_STATEMENTS', default=True, cast=bool)
+# Seconds a worker thread keeps its database connections (and the statements
+# prepared on them) open across requests; 0 closes them after every request
+DB_CONN_MAX_AGE = config('DB_CONN_MAX_AGE', default=600, cast=int)
+
+# IMO detail rows are cached for RECORD_CACHE_TTL seconds, unknown IMOs for
+# RECORD_NEGATIVE_TTL seconds (app/records.py)
+RECORD_CACHE_TTL = config('RECORD_CACHE_TTL', default=5 * 60, cast=int)
+RECORD_NEGATIVE_TTL = config('RECORD_NEGATIVE_TTL', default=60, cast=int)
+
+# /db/ greetings are inserted in batches of GREETING_BATCH_SIZE or every
+# GREETING_FLUSH_SECONDS, and trimmed after GREETING_RETENTION_DAYS (app/greetings.py)
+GREETING_BATCH_SIZE = config('GREETING_BATCH_SIZE', default=100, cast=int)
+GREETING_FLUSH_SECONDS = config('GREETING_FLUSH_SECONDS', default=5, cast=float)
+GREETING_RETENTION_DAYS = config('GREETING_RETENTION_DAYS', default=7, cast=int)
+GREETING_PAGE_SIZE = config('GREETING_PAGE_SIZE', default=20, cast=int)
+
+# Live updates over /live/ (app/live.py): changes are batched for
+# LIVE_DEBOUNCE_SECONDS and each stream is reopened after LIVE_STREAM_SECONDS
+LIVE_DEBOUNCE_SECONDS = config('LIVE_DEBOUNCE_SECONDS', default=1, cast=float)
+LIVE_HEARTBEAT_SECONDS = config('LIVE_HEARTBEAT_SECONDS', default=15, cast=int)
+LIVE_STREAM_SECONDS = config('LIVE_STREAM_SECONDS', default=5 * 60, cast=int)
+# Streams per worker; keep it below GUNICORN_THREADS so other requests get a thread
+LIVE_MAX_STREAMS = config('LIVE_MAX_STREAMS', default=4, cast=int)
+
+# Rendered pages of the table views are cached until their tables change, or
+# for at most TABLE_FRAGMENT_TTL seconds (app/tables.py)
+TABLE_FRAGMENT_TTL = config('TABLE_FRAGMENT_TTL', default=10 * 60, cast=int)
+
 WSGI_APPLICATION = 'core.wsgi.application'
 
 # Database
@@ -84,7 +148,8 @@ if RUN_LOCAL_DB:
             'NAME': config('LOCAL_DB_NAME', default='test'),
             'USER': config('LOCAL_DB_USER', default=''),
             'HOST': 'localhost',
-            'PORT': 5432
+            'PORT': 5432,
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
         }
     }
     # If no password is used, the value must not appear in the configuration
@@ -92,6 +157,10 @@ if RUN_LOCAL_DB:
     LOCAL_DB_PASSWORD = config('LOCAL_DB_PASSWORD', default='')
     if LOCAL_DB_PASSWORD:
         DATABASES['default']['PASSWORD'] = LOCAL_DB_PASSWORD
+    # A second local database can stand in for a read replica
+    LOCAL_REPLICA_DB_NAME = config('LOCAL_REPLICA_DB_NAME', default='')
+    if LOCAL_REPLICA_DB_NAME:
+        DATABASES['replica'] = dict(DATABASES['default'], NAME=LOCAL_REPLICA_DB_NAME)
 else:
     DATABASES = {
         'default': {
@@ -100,9 +169,21 @@ else:
             'USER': config('DB_USER', default=None),
             'PASSWORD': config('DB_PASSWORD', default=None),
             'HOST': config('DB_HOST', default=None),
-            'PORT': 5432
+            'PORT': 5432,
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
         }
     }
+    REPLICA_DATABASE_URL = config('REPLICA_DATABASE_URL', default='')
+    if REPLICA_DATABASE_URL:
+        DATABASES['replica'] = dj_database_url.parse(REPLICA_DATABASE_URL, conn_max_age=DB_CONN_MAX_AGE)
+
+# Read-only views are routed to the replicas (app/routers.py). A browser that
+# just wrote reads from the primary for REPLICA_PIN_SECONDS afterwards.
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+for alias in DATABASE_REPLICAS:
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['app.routers.PrimaryReplicaRouter']
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=5, cast=int)
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -2,10 +2,17 @@ from django.urls import path
 from django.contrib import admin
 #from mysite.core import views
 
+import app.admin
+from app.admission import limit
 import app.views
 
 admin.autodiscover()
 
+# Admission limits of the views running heavy queries (see app/admission.py):
+# concurrent runs across all workers, requests allowed to wait for a slot, and
+# per query statement timeout (ms) and row cap. /visual/ and /adv_q_visual/
+# are served from their cached copy (app/dashboards.py), so they need none
+HEAVY = dict(concurrency=2, queue=4, queue_timeout=5, statement_timeout=15000)
 
 
 urlpatterns = [
@@ -15,10 +22,17 @@ urlpatterns = [
     path('emissions/<int:page>', app.views.emissions, name='emissions'),
     path('emissions/imo/', app.views.emission_detail, name='emission_detail'),
     path('emissions/imo/<int:imo>', app.views.emission_detail, name='emission_detail'),
+    path('admin/profiles/', admin.site.admin_view(app.admin.profiles), name='profiles'),
+    path('admin/profiles/<str:capture_id>', admin.site.admin_view(app.admin.profile_download), name='profile_download'),
+    path('admin/profiles/<str:capture_id>/<str:format>', admin.site.admin_view(app.admin.profile_download), name='profile_download'),
     path('admin/', admin.site.urls),
     path('aggregation/', app.views.aggregation, name='aggregation'), 
     path('visual/', app.views.visual, name='visual'), 
+    path('visual/fits/', limit(app.views.regression_fits, **HEAVY), name='regression_fits'),
     path('adv_q_visual/', app.views.adv_q_visual, name='adv_q_visual'), 
+    path('adv_q_visual/percentiles/', limit(app.views.eedi_percentiles, **HEAVY), name='eedi_percentiles'),
+    path('cube/', limit(app.views.cube_slice, **HEAVY, max_rows=100000), name='cube_slice'),
+    path('live/', app.views.live_updates, name='live_updates'),
     path('fact/', app.views.fact, name='fact'),
     path('fact/<int:page>', app.views.fact, name='fact'),
     path('ship_dim/', app.views.ship_dim, name='ship_dim'),
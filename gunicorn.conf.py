@@ -0,0 +1,31 @@
+# Loaded by gunicorn from the working directory (see Procfile)
+import os
+import threading
+
+# /live/ keeps a request open per browser tab, so serve requests from threads
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def post_worker_init(worker):
+    # Each worker keeps its own caches, so each one listens for changes
+    from app import invalidation
+    invalidation.start_listener()
+
+    # Build the chart pages before the worker takes requests, telling the
+    # arbiter meanwhile that it is alive so a slow build is not timed out
+    from app import dashboards
+    import app.views  # noqa: F401
+    warmed = threading.Event()
+
+    def heartbeat():
+        while not warmed.wait(1):
+            worker.notify()
+
+    threading.Thread(target=heartbeat, name='dashboard-warm-heartbeat', daemon=True).start()
+    try:
+        dashboards.warm(stale_in_background=True)
+    except Exception:
+        worker.log.exception('Warming the dashboards failed; they are built on first request')
+    finally:
+        warmed.set()